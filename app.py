@@ -4,38 +4,58 @@ import os
 import uuid
 from typing import List, Optional
 
-import aiohttp
-from fastapi import Depends, FastAPI, HTTPException, Cookie, UploadFile, Header
+from fastapi import Depends, FastAPI, HTTPException, Cookie, UploadFile, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from starlette.responses import RedirectResponse
-
-from dbsql import crud, models, schemas
-from dbsql.database import SessionLocal, engine
+from fastapi.responses import ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.responses import RedirectResponse, StreamingResponse
+
+from dbsql import crud, migrations, models, schemas
+from dbsql.cache import TTLCache, user_cache, versions
+from dbsql.database import (LISTEN_DATABASE_DSN, MAX_OVERFLOW, POOL_SIZE, AsyncSessionLocal, async_engine,
+                            replica_engines, replica_session)
 from dbsql.schemas import OsuUserCreate, DiscordUser
-from utils.image import check_image_is_in_formats, upload_binary_file_to_imgur
+from utils import avatar_jobs, bus, events, http, ingest, metrics, osu, pagination, profiler, ratelimit
+from utils.etag import ConditionalGetMiddleware
+from utils.image import hash_upload, make_avatar
+from utils.metrics import MetricsMiddleware
+from utils.profiler import QueryProfilerMiddleware
+from utils.ratelimit import AdmissionMiddleware, RouteLimit
+from utils.replicas import REPLICA_MAX_LAG, STICKY_COOKIE, ReadYourWritesMiddleware
+from utils.uploads import BodySizeLimitMiddleware
 
 ONE_MONTH = 2592000
-BADGE_WORD_FILTER = [
-    "taiko",
-    "catch",
-    "mania",
-    "mapping",
-    "nominator",
-    "nomination",
-    "beatmap",
-    "contribution",
-    "mappers'",
-    "mapper's",
-    "mapper",
-    "spotlight",
-    "playlist",
-    "fanart",
-]
-
-models.Base.metadata.create_all(bind=engine)
+AVATAR_MAX_UPLOAD_SIZE = 10000000  # 10 MB
+# Most SQL statements the hot read endpoints may run in development before the profiler complains.
+QUERY_BUDGETS = {
+    "/users": 1,
+    "/teams": 2,
+    "/lobbies": 3,
+}
+
+# Per client rate and burst for the write and sign-in routes, by method and path. Each route may also
+# hold at most the whole connection pool at once, so one busy route cannot queue everything else behind it.
+ROUTE_CONCURRENCY = POOL_SIZE + MAX_OVERFLOW
+ROUTE_LIMITS = {
+    ("GET", "/osu-identify"): RouteLimit(rate=0.2, burst=5, concurrency=ROUTE_CONCURRENCY),
+    ("GET", "/discord-identify"): RouteLimit(rate=0.2, burst=5, concurrency=ROUTE_CONCURRENCY),
+    ("PUT", "/users/me"): RouteLimit(rate=0.5, burst=5, concurrency=ROUTE_CONCURRENCY),
+    ("POST", "/team"): RouteLimit(rate=0.5, burst=5, concurrency=ROUTE_CONCURRENCY),
+    ("DELETE", "/team"): RouteLimit(rate=0.5, burst=5, concurrency=ROUTE_CONCURRENCY),
+    ("POST", "/team/invite"): RouteLimit(rate=1, burst=10, concurrency=ROUTE_CONCURRENCY),
+    ("DELETE", "/team/invite"): RouteLimit(rate=1, burst=10, concurrency=ROUTE_CONCURRENCY),
+    ("POST", "/user/team/join"): RouteLimit(rate=0.5, burst=5, concurrency=ROUTE_CONCURRENCY),
+    ("DELETE", "/user/invite"): RouteLimit(rate=1, burst=10, concurrency=ROUTE_CONCURRENCY),
+    ("POST", "/user/lobby/join"): RouteLimit(rate=0.5, burst=5, concurrency=ROUTE_CONCURRENCY),
+    ("POST", "/user/lobby/leave"): RouteLimit(rate=0.5, burst=5, concurrency=ROUTE_CONCURRENCY),
+    ("POST", "/avatar/upload"): RouteLimit(rate=0.1, burst=3, concurrency=ROUTE_CONCURRENCY),
+}
+# user_hash cookies the auth dependencies accepted lately. The rate limits key on the user only for
+# these and on the client address otherwise, so made-up cookies cannot buy fresh buckets.
+signed_in_users = TTLCache(maxsize=ratelimit.MAX_CLIENTS, ttl=ONE_MONTH)
 
 frontend_homepage = os.getenv("FRONTEND_HOMEPAGE")
+SIGN_UPS_CLOSE = datetime.datetime.fromisoformat(os.getenv("SIGN_UPS_CLOSE", "2022-11-27T16:00:00"))
 
 if os.getenv("DEV"):
     app = FastAPI()
@@ -50,54 +70,151 @@ else:
         "https://gstlive.org",
         "http://gstlive.org",
     ]
+# Added before CORS so that 304s and 413s still pass through it.
+app.add_middleware(BodySizeLimitMiddleware, limits={"/avatar/upload": AVATAR_MAX_UPLOAD_SIZE})
+app.add_middleware(
+    ConditionalGetMiddleware,
+    etag_for=versions.etag,
+    routes={
+        "/users": ("roster",),
+        "/teams": ("roster",),
+        "/lobbies": ("roster", "lobbies"),
+        "/lobby": ("roster", "lobbies"),
+        "/mappool": ("mappool",),
+        "/mappool/team_scores": ("scores",),
+        "/mappool/player_scores": ("scores",),
+        "/team/scores": ("scores",),
+        "/user/scores": ("scores",),
+    },
+)
+# Inside CORS, so browsers can read the 429s and 503s.
+app.add_middleware(AdmissionMiddleware, limits=ROUTE_LIMITS,
+                   is_user=lambda user_hash: signed_in_users.get(user_hash) is not None)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Standings-Version", "X-Lobby-Occupancy", "ETag", "Retry-After"]
 )
+if replica_engines:
+    app.add_middleware(ReadYourWritesMiddleware)
+if os.getenv("DEV"):
+    app.add_middleware(QueryProfilerMiddleware,
+                       budgets=QUERY_BUDGETS,
+                       default_budget=int(os.getenv("QUERY_BUDGET")) if os.getenv("QUERY_BUDGET") else None,
+                       strict=bool(os.getenv("QUERY_BUDGET_STRICT")),
+                       exclude=("/debug/queries", "/metrics"))
+# Outermost, so the recorded latency covers every other middleware.
+app.add_middleware(MetricsMiddleware)
+
+
+@app.on_event("startup")
+async def migrate_database():
+    await migrations.migrate(async_engine)
+
+
+@app.on_event("startup")
+async def start_cache_bus():
+    await bus.start(LISTEN_DATABASE_DSN)
+    versions.refresh()
+
+
+@app.on_event("startup")
+async def start_rate_limit_sharing():
+    ratelimit.start()
+
+
+@app.on_event("startup")
+async def open_http_sessions():
+    await http.open_sessions()
+
+
+@app.on_event("startup")
+async def start_avatar_workers():
+    avatar_jobs.start()
+
+
+@app.on_event("shutdown")
+async def stop_avatar_workers():
+    await avatar_jobs.stop()
+
+
+@app.on_event("shutdown")
+async def stop_rate_limit_sharing():
+    await ratelimit.stop()
+
+
+@app.on_event("shutdown")
+async def close_http_sessions():
+    await http.close_sessions()
+
+
+@app.on_event("shutdown")
+async def close_database():
+    await bus.stop()
+    await async_engine.dispose()
+    for replica_engine in replica_engines:
+        await replica_engine.dispose()
 
 
 # Dependency
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-def verify_content_length_exists(content_length: str | None = Header()):
-    if not content_length:
-        raise HTTPException(411)
+def get_read_db(*resources: str):
+    # For plain reads that may trail the primary by up to REPLICA_MAX_LAG. Clients that just wrote
+    # stay on the primary, and so does everyone while one of the resources behind the route's ETag
+    # has changed within that window, so a fresh tag is never put on a replica's stale rows.
+    async def read_db(read_primary: str | None = Cookie(default=None, alias=STICKY_COOKIE)):
+        if not replica_engines or read_primary or versions.changed_within(REPLICA_MAX_LAG, *resources):
+            async with AsyncSessionLocal() as db:
+                yield db
+        else:
+            async with replica_session() as db:
+                yield db
+    return read_db
+
+
+async def get_current_user(db: AsyncSession = Depends(get_db),
+                           user_hash: str | None = Cookie(default=None)) -> models.User:
+    db_user = await crud.get_user(db=db, user_hash=user_hash)
+    if db_user is None:
+        raise HTTPException(401, "You are not logged in.")
+    signed_in_users.set(user_hash, True)
+    return db_user
 
 
-def verify_content_less_than_max_size(content_length: str = Header()):
-    max_upload_size = 10000000  # 10 MB
-    file_size = int(content_length)
-    if file_size > max_upload_size:
-        raise HTTPException(413)
+async def get_cached_user(db: AsyncSession = Depends(get_db),
+                          user_hash: str | None = Cookie(default=None)) -> schemas.User:
+    user = user_cache.get(user_hash)
+    if user is None:
+        db_user = await get_current_user(db=db, user_hash=user_hash)
+        user = schemas.User.from_orm(db_user)
+        user_cache.set(user_hash, user)
+    else:
+        signed_in_users.set(user_hash, True)
+    return user
 
 
-def user_is_admin(db: Session = Depends(get_db), user_hash: str | None = Cookie(default=None)):
-    db_user = crud.get_user(db=db, user_hash=user_hash)
-    if not db_user.is_admin:
+def user_is_admin(user: schemas.User = Depends(get_cached_user)):
+    if not user.is_admin:
         raise HTTPException(403, "You require admin privileges.")
 
 
-def user_is_not_admin(db: Session = Depends(get_db), user_hash: str | None = Cookie(default=None)):
+def user_is_not_admin(user: schemas.User = Depends(get_cached_user)):
     if os.getenv("DEV"):
         return
 
-    db_user = crud.get_user(db=db, user_hash=user_hash)
-    if db_user.is_admin:
+    if user.is_admin:
         raise HTTPException(403, "You are an admin, not a player.")
 
 
-def user_is_not_banned(db: Session = Depends(get_db), user_hash: str | None = Cookie(default=None)):
-    db_user = crud.get_user(db=db, user_hash=user_hash)
-    if db_user.is_banned:
+def user_is_not_banned(user: schemas.User = Depends(get_cached_user)):
+    if user.is_banned:
         raise HTTPException(403, "You are banned.")
 
 
@@ -112,11 +229,12 @@ def hash_with_random(string_to_be_hashed: str) -> str:
 
 
 def sign_ups_open_period():
-    if datetime.datetime.now() > datetime.datetime.fromisoformat("2022-11-27T16:00:00"):
+    if datetime.datetime.now() > SIGN_UPS_CLOSE:
         raise HTTPException(401, "Sign-ups are closed.")
 
 
-async def oauth2_authorization(code: str,
+async def oauth2_authorization(upstream: str,
+                               code: str,
                                client_id: str,
                                client_secret: str,
                                redirect_uri: str,
@@ -128,62 +246,51 @@ async def oauth2_authorization(code: str,
         "grant_type": "authorization_code",
         "redirect_uri": redirect_uri
     }
-    async with aiohttp.ClientSession() as sess:
-        async with sess.post(token_endpoint, data=token_body) as resp:
+    async with http.upstream_errors(upstream):
+        async with http.get_session(upstream).post(token_endpoint, data=token_body) as resp:
             contents = await resp.json()
 
-        access_token = contents.get("access_token")
-        if not access_token:
-            raise HTTPException(500,
-                                "Something went wrong with the authentication, didn't get access token...")
+    access_token = contents.get("access_token")
+    if not access_token:
+        raise HTTPException(500,
+                            "Something went wrong with the authentication, didn't get access token...")
 
     return access_token
 
 
-async def get_me_data(access_token, me_endpoint):
+async def get_me_data(upstream, access_token, me_endpoint):
     headers = {"Authorization": f"Bearer {access_token}"}
-    async with aiohttp.ClientSession(headers=headers) as sess:
-        async with sess.get(me_endpoint) as resp:
+    async with http.upstream_errors(upstream):
+        async with http.get_session(upstream).get(me_endpoint, headers=headers) as resp:
             me_result = await resp.json()
 
     return me_result
 
 
 @app.get("/osu-identify", response_class=RedirectResponse)
-async def osu_identify(code: str, db: Session = Depends(get_db)) -> RedirectResponse:
-    access_token = await oauth2_authorization(code=code,
+async def osu_identify(code: str, db: AsyncSession = Depends(get_db)) -> RedirectResponse:
+    access_token = await oauth2_authorization(upstream="osu",
+                                              code=code,
                                               client_id=os.getenv("OSU_CLIENT_ID"),
                                               client_secret=os.getenv("OSU_CLIENT_SECRET"),
                                               redirect_uri=os.getenv("REDIRECT_URI") + "/osu-identify",
-                                              token_endpoint=r"https://osu.ppy.sh/oauth/token")
-    me_result = await get_me_data(access_token, r"https://osu.ppy.sh/api/v2/me/osu")
+                                              token_endpoint="/oauth/token")
+    me_result = await get_me_data("osu", access_token, "/api/v2/me/osu")
     osu_id = me_result["id"]
     user_hash = hash_with_secret(osu_id)
     redirect = RedirectResponse(frontend_homepage)
 
-    db_user = crud.get_user_by_osu_id(db=db, osu_id=osu_id)
+    db_user = await crud.get_user_by_osu_id(db=db, osu_id=osu_id)
     if db_user:
         redirect.set_cookie(key="user_hash", value=db_user.user_hash, max_age=ONE_MONTH)
+        signed_in_users.set(db_user.user_hash, True)
         return redirect
     else:
         redirect.set_cookie(key="user_hash", value=user_hash, max_age=ONE_MONTH)
 
     global_rank = me_result["statistics"]["global_rank"]
-    badges = me_result["badges"]
-
-    num_badges = 0
-    for badge in badges:
-        badge_desc: str = badge["description"]
-        description = badge_desc.casefold()
-
-        # If description contains any word that is in filter
-        if any(filter_word in description for filter_word in BADGE_WORD_FILTER):
-            continue
-
-        num_badges += 1
-
-    num = global_rank if global_rank and global_rank >= 0 else 0
-    bws_rank = round(num ** (0.9937 ** (num_badges ** 2)))
+    num_badges = osu.count_badges(me_result["badges"])
+    bws_rank = osu.bws_rank(global_rank, num_badges)
 
     user = OsuUserCreate(osu_id=osu_id,
                          osu_username=me_result["username"],
@@ -193,21 +300,28 @@ async def osu_identify(code: str, db: Session = Depends(get_db)) -> RedirectResp
                          bws_rank=bws_rank,
                          badges=num_badges)
 
-    crud.create_osu_user(db=db, user=user)
+    await crud.create_osu_user(db=db, user=user)
+    signed_in_users.set(user_hash, True)
 
     return redirect
 
 
 @app.get("/discord-identify", response_class=RedirectResponse, dependencies=[Depends(sign_ups_open_period)])
-async def discord_identify(code: str, db: Session = Depends(get_db),
+async def discord_identify(code: str, db: AsyncSession = Depends(get_db),
                            user_hash: str | None = Cookie(default=None)):
-    access_token = await oauth2_authorization(code=code,
+    if not user_hash:
+        raise HTTPException(401, "You are not logged in.")
+    # The user is looked up only after the Discord calls, so no pooled connection sits idle in a
+    # transaction while they are in flight.
+    access_token = await oauth2_authorization(upstream="discord",
+                                              code=code,
                                               client_id=os.getenv("DISCORD_CLIENT_ID"),
                                               client_secret=os.getenv("DISCORD_CLIENT_SECRET"),
                                               redirect_uri=os.getenv("REDIRECT_URI") + "/discord-identify",
-                                              token_endpoint=r"https://discord.com/api/oauth2/token")
-    me_result = await get_me_data(access_token=access_token,
-                                  me_endpoint=r"https://discord.com/api/v10/users/@me")
+                                              token_endpoint="/api/oauth2/token")
+    me_result = await get_me_data(upstream="discord",
+                                  access_token=access_token,
+                                  me_endpoint="/api/v10/users/@me")
     user_id = me_result["id"]
     username = me_result["username"]
     discriminator = me_result["discriminator"]
@@ -217,192 +331,315 @@ async def discord_identify(code: str, db: Session = Depends(get_db),
                        discord_avatar_url=avatar_url,
                        discord_tag=f"{username}#{discriminator}",
                        )
-    crud.upgrade_to_discord_user(db=db, user_hash=user_hash, user=user)
+    db_user = await get_current_user(db=db, user_hash=user_hash)
+    await crud.upgrade_to_discord_user(db=db, db_user=db_user, user=user)
 
     redirect = RedirectResponse(frontend_homepage)
-    redirect.set_cookie(key="user", value=user_hash, max_age=ONE_MONTH)
+    redirect.set_cookie(key="user", value=db_user.user_hash, max_age=ONE_MONTH)
     return redirect
 
 
 @app.get("/users/me", response_model=schemas.User)
-async def read_me(db: Session = Depends(get_db),
-                  user_hash: str = Cookie(default=None)):
-    user = crud.get_user(db=db, user_hash=user_hash)
+async def read_me(user: schemas.User = Depends(get_cached_user)):
     return user
 
 
 @app.put("/users/me", response_model=schemas.User)
-async def unlink_user_discord(db: Session = Depends(get_db),
-                              user_hash: str = Cookie(default=None)):
-    user = crud.downgrade_from_discord_user(db=db, user_hash=user_hash)
+async def unlink_user_discord(db: AsyncSession = Depends(get_db),
+                              db_user: models.User = Depends(get_current_user)):
+    user = await crud.downgrade_from_discord_user(db=db, db_user=db_user)
     return user
 
 
 @app.get("/users/me/invites", response_model=List[schemas.Invite])
-async def read_user_invites(db: Session = Depends(get_db),
+async def read_user_invites(db: AsyncSession = Depends(get_db),
                             user_hash: str = Cookie(default=None)):
-    invites = crud.get_user_invites(db=db, user_hash=user_hash)
+    invites = await crud.get_user_invites(db=db, user_hash=user_hash)
     return invites
 
 
+@app.post("/users/osu/refresh", dependencies=[Depends(user_is_admin)], response_model=schemas.ProfileRefresh)
+async def refresh_osu_profiles(db: AsyncSession = Depends(get_db)):
+    return await osu.refresh_profiles(db=db)
+
+
 @app.get("/users", response_model=List[schemas.User])
-async def read_users(db: Session = Depends(get_db)):
-    users = crud.get_users(db=db)
-    return users
+async def read_users(cursor: Optional[str] = None, limit: int = Query(default=100, ge=1, le=500),
+                     has_team: Optional[bool] = None, discord_linked: Optional[bool] = None,
+                     is_banned: Optional[bool] = None, in_lobby: Optional[bool] = None,
+                     db: AsyncSession = Depends(get_read_db("roster"))):
+    after = pagination.decode_cursor(cursor, size=2)
+    if after is not None and (not isinstance(after[0], str) or type(after[1]) is not int):
+        raise HTTPException(400, "Invalid cursor.")
+    users, last = await crud.get_user_rows(db=db, after=after, limit=limit,
+                                           has_team=has_team, discord_linked=discord_linked, is_banned=is_banned,
+                                           in_lobby=in_lobby)
+    response = ORJSONResponse(users)
+    if len(users) == limit:
+        response.headers["X-Next-Cursor"] = pagination.encode_cursor(*last)
+    return response
 
 
 @app.post("/team", response_model=schemas.Team,
           dependencies=[Depends(user_is_not_banned), Depends(user_is_not_admin), Depends(sign_ups_open_period)])
-async def create_team(team: schemas.TeamCreate, db: Session = Depends(get_db),
-                      user_hash: str | None = Cookie(default=None)):
-    team_hash = hash_with_random(user_hash)
-    team = crud.create_team(db=db, team=team, user_hash=user_hash, team_hash=team_hash)
+async def create_team(team: schemas.TeamCreate, db: AsyncSession = Depends(get_db),
+                      db_user: models.User = Depends(get_current_user)):
+    team_hash = hash_with_random(db_user.user_hash)
+    team = await crud.create_team(db=db, team=team, db_user=db_user, team_hash=team_hash)
 
     return team
 
 
 @app.delete("/team", response_model=schemas.User,
             dependencies=[Depends(user_is_not_banned), Depends(sign_ups_open_period)])
-async def leave_team(db: Session = Depends(get_db),
-                     user_hash: str | None = Cookie(default=None)):
-    db_user = crud.leave_team(db=db, user_hash=user_hash)
+async def leave_team(db: AsyncSession = Depends(get_db),
+                     db_user: models.User = Depends(get_current_user)):
+    db_user = await crud.leave_team(db=db, db_user=db_user)
 
     return db_user
 
 
 @app.get("/team/invites", response_model=List[schemas.Invite])
-async def read_team_invites(team_hash: str, db: Session = Depends(get_db)):
-    return crud.get_team_invites(db=db, team_hash=team_hash)
+async def read_team_invites(team_hash: str, db: AsyncSession = Depends(get_db)):
+    return await crud.get_team_invites(db=db, team_hash=team_hash)
 
 
 @app.get("/teams", response_model=List[schemas.Team])
-async def read_teams(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    teams = crud.get_teams(db, skip=skip, limit=limit)
-    return teams
+async def read_teams(cursor: Optional[str] = None, limit: int = Query(default=100, ge=1, le=500),
+                     in_lobby: Optional[bool] = None, db: AsyncSession = Depends(get_read_db("roster"))):
+    after = pagination.decode_cursor(cursor, size=1)
+    if after is not None and not isinstance(after[0], str):
+        raise HTTPException(400, "Invalid cursor.")
+    teams = await crud.get_team_rows(db, after=after[0] if after else None, limit=limit, in_lobby=in_lobby)
+    response = ORJSONResponse(teams)
+    if len(teams) == limit:
+        response.headers["X-Next-Cursor"] = pagination.encode_cursor(teams[-1]["title"])
+    return response
 
 
 @app.post("/user/team/join", response_model=schemas.User,
           dependencies=[Depends(user_is_not_banned), Depends(sign_ups_open_period)])
-async def user_join_team(team_hash: str, db: Session = Depends(get_db),
-                         user_hash: str | None = Cookie(default=None)):
-    db_user = crud.add_player_to_team(db=db, team_hash=team_hash, user_hash=user_hash)
+async def user_join_team(team_hash: str, db: AsyncSession = Depends(get_db),
+                         db_user: models.User = Depends(get_current_user)):
+    db_user = await crud.add_player_to_team(db=db, team_hash=team_hash, db_user=db_user)
 
     return db_user
 
 
 @app.post("/user/lobby/join", response_model=schemas.Team, dependencies=[Depends(user_is_not_banned)])
-async def add_user_to_lobby(lobby_id: int, db: Session = Depends(get_db),
-                            user_hash: str | None = Cookie(default=None)):
-    return crud.add_team_to_lobby(db=db, user_hash=user_hash, lobby_id=lobby_id)
+async def add_user_to_lobby(lobby_id: int, response: Response, db: AsyncSession = Depends(get_db),
+                            db_user: models.User = Depends(get_current_user)):
+    team, occupancy = await crud.add_team_to_lobby(db=db, db_user=db_user, lobby_id=lobby_id)
+    response.headers["X-Lobby-Occupancy"] = str(occupancy)
+    return team
 
 
 @app.post("/user/lobby/leave", response_model=schemas.Team, dependencies=[Depends(user_is_not_banned)])
-async def leave_from_lobby(db: Session = Depends(get_db),
-                           user_hash: str | None = Cookie(default=None)):
-    return crud.remove_team_from_lobby(db=db, user_hash=user_hash)
+async def leave_from_lobby(db: AsyncSession = Depends(get_db),
+                           db_user: models.User = Depends(get_current_user)):
+    return await crud.remove_team_from_lobby(db=db, db_user=db_user)
+
+
+@app.get("/events")
+async def read_events(user_hash: str | None = Cookie(default=None)):
+    # Resolved with a short-lived session so the stream does not pin a pooled connection. Team
+    # events are only streamed to the caller's own team.
+    channels = {events.LOBBIES_CHANNEL}
+    if user_hash:
+        try:
+            async with AsyncSessionLocal() as db:
+                user = await get_cached_user(db=db, user_hash=user_hash)
+        except HTTPException:
+            user = None
+        if user is not None:
+            channels.add(events.user_channel(user_hash))
+            if user.team:
+                channels.add(events.team_channel(user.team.team_hash))
+
+    return StreamingResponse(events.stream(*channels), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.post("/team/invite", response_model=schemas.Invite,
           dependencies=[Depends(user_is_not_banned), Depends(sign_ups_open_period)])
 async def team_create_invite(other_user_osu_id: int,
-                             db: Session = Depends(get_db),
-                             user_hash: str | None = Cookie(default=None)):
-    return crud.create_invite(db=db, team_owner_hash=user_hash, invited_user_osu_id=other_user_osu_id)
+                             db: AsyncSession = Depends(get_db),
+                             db_user: models.User = Depends(get_current_user)):
+    return await crud.create_invite(db=db, team_owner=db_user, invited_user_osu_id=other_user_osu_id)
 
 
 @app.delete("/team/invite", response_model=Optional[List[schemas.Invite]])
 async def team_cancel_invite(other_user_osu_id: int,
-                             db: Session = Depends(get_db),
-                             user_hash: str | None = Cookie(default=None)):
-    return crud.cancel_invite(db=db, user_hash=user_hash, invited_user_osu_id=other_user_osu_id)
+                             db: AsyncSession = Depends(get_db),
+                             db_user: models.User = Depends(get_current_user)):
+    return await crud.cancel_invite(db=db, inviter_user=db_user, invited_user_osu_id=other_user_osu_id)
 
 
 @app.delete("/user/invite", response_model=schemas.User,
             dependencies=[Depends(user_is_not_banned), Depends(sign_ups_open_period)])
 async def user_decline_invite(team_hash: str,
-                              db: Session = Depends(get_db),
-                              user_hash: str | None = Cookie(default=None)):
-    return crud.decline_invite(db=db, user_hash=user_hash, team_hash=team_hash)
+                              db: AsyncSession = Depends(get_db),
+                              db_user: models.User = Depends(get_current_user)):
+    return await crud.decline_invite(db=db, db_user=db_user, team_hash=team_hash)
 
 
-@app.post("/avatar/upload", response_model=schemas.Team,
-          dependencies=[Depends(user_is_not_banned), Depends(verify_content_length_exists),
-                        Depends(verify_content_less_than_max_size), Depends(sign_ups_open_period)])
+@app.post("/avatar/upload", response_model=schemas.AvatarJob, status_code=202,
+          dependencies=[Depends(user_is_not_banned), Depends(sign_ups_open_period)])
 async def create_avatar(file: UploadFile,
-                        db: Session = Depends(get_db),
-                        user_hash: str | None = Cookie(default=None)):
-    if not check_image_is_in_formats(image_file=file.file,
-                                     formats=['png', 'jpg', 'jpeg', 'gif']):
-        raise HTTPException(400,
-                            "Uploaded file must be one of the following formats: '.png', '.jpg', '.jpeg', or '.gif'")
-
-    img_response = await upload_binary_file_to_imgur(file=file, imgur_client_id=os.getenv("IMGUR_CLIENT_ID"))
-    img_url = img_response["link"]
-    return crud.create_avatar(db=db, user_hash=user_hash, img_url=img_url)
+                        db: AsyncSession = Depends(get_db),
+                        db_user: models.User = Depends(get_current_user)):
+    # Known images resolve to their hosted copy without decoding or another imgur upload.
+    source_hash = await hash_upload(file.file)
+    img_url = await crud.find_cached_avatar(db, source_hash)
+    if img_url is not None:
+        return await crud.create_avatar_job(db=db, db_user=db_user, source_hash=source_hash, img_url=img_url)
+
+    avatar = await make_avatar(file.file)
+    img_url = await crud.find_cached_avatar(db, avatar.pixel_hash)
+    job = await crud.create_avatar_job(db=db, db_user=db_user, source_hash=source_hash, pixel_hash=avatar.pixel_hash,
+                                       image=avatar.image, img_url=img_url)
+    if img_url is None:
+        avatar_jobs.notify()
+    return job
+
+
+@app.get("/avatar/job", response_model=schemas.AvatarJob)
+async def read_avatar_job(job_id: str, db: AsyncSession = Depends(get_db),
+                          db_user: models.User = Depends(get_current_user)):
+    job = await crud.get_avatar_job(db=db, job_id=job_id, team_hash=db_user.team_hash)
+    if job is None:
+        raise HTTPException(404, "Avatar job not found.")
+    return job
 
 
 @app.post("/user/ban", dependencies=[Depends(user_is_admin)], response_model=schemas.User)
 async def ban_user(user_osu_id: int,
-                   db: Session = Depends(get_db)):
-    return crud.ban_user(db=db, user_osu_id=user_osu_id)
+                   db: AsyncSession = Depends(get_db)):
+    return await crud.ban_user(db=db, user_osu_id=user_osu_id)
 
 
 @app.delete("/user/ban", dependencies=[Depends(user_is_admin)], response_model=schemas.User)
 async def unban_user(user_osu_id: int,
-                     db: Session = Depends(get_db)):
-    return crud.unban_user(db=db, user_osu_id=user_osu_id)
+                     db: AsyncSession = Depends(get_db)):
+    return await crud.unban_user(db=db, user_osu_id=user_osu_id)
 
 
 @app.get("/lobbies", response_model=Optional[List[schemas.Lobby]])
-async def get_lobbies(db: Session = Depends(get_db)):
-    return crud.get_lobbies(db=db)
+async def get_lobbies(db: AsyncSession = Depends(get_read_db("roster", "lobbies"))):
+    return ORJSONResponse(await crud.get_lobby_rows(db=db))
 
 
 @app.get("/lobby", response_model=Optional[schemas.Lobby])
-async def get_lobby(lobby_id: int, db: Session = Depends(get_db)):
-    return crud.get_lobby(db=db, lobby_id=lobby_id)
+async def get_lobby(lobby_id: int, db: AsyncSession = Depends(get_read_db("roster", "lobbies"))):
+    return await crud.get_lobby(db=db, lobby_id=lobby_id)
 
 
 @app.delete("/lobby", dependencies=[Depends(user_is_admin)], response_model=Optional[schemas.Lobby])
-async def remove_lobby(lobby_id: int, db: Session = Depends(get_db)):
-    return crud.remove_lobby(db=db, lobby_id=lobby_id)
+async def remove_lobby(lobby_id: int, db: AsyncSession = Depends(get_db)):
+    return await crud.remove_lobby(db=db, lobby_id=lobby_id)
 
 
 @app.post("/lobby/create", dependencies=[Depends(user_is_admin)], response_model=schemas.Lobby)
 async def create_lobby(lobby_time: datetime.datetime, lobby_name: str,
-                       db: Session = Depends(get_db), referee_osu_username: Optional[str] = None):
-    return crud.create_lobby(db=db, referee_osu_username=referee_osu_username, lobby_time=lobby_time,
+                       db: AsyncSession = Depends(get_db), referee_osu_username: Optional[str] = None):
+    return await crud.create_lobby(db=db, referee_osu_username=referee_osu_username, lobby_time=lobby_time,
                              lobby_name=lobby_name)
 
 
 @app.post("/lobby/add_referee", dependencies=[Depends(user_is_admin)], response_model=schemas.Lobby)
 async def add_referee_to_lobby(referee_osu_username: str, lobby_id: int,
-                               db: Session = Depends(get_db)):
-    return crud.add_referee_to_lobby(db=db, referee_osu_username=referee_osu_username, lobby_id=lobby_id)
+                               db: AsyncSession = Depends(get_db)):
+    return await crud.add_referee_to_lobby(db=db, referee_osu_username=referee_osu_username, lobby_id=lobby_id)
 
 
 @app.get("/mappool", response_model=List[schemas.Mappool])
-async def get_mappool(mappool_type: str = "QF", db: Session = Depends(get_db)):
-    maps = crud.get_mappool(db=db, mappool_type=mappool_type)
+async def get_mappool(mappool_type: str = "QF", db: AsyncSession = Depends(get_db)):
+    maps = await crud.get_mappool(db=db, mappool_type=mappool_type)
     return maps
 
 
+@app.put("/mappool", dependencies=[Depends(user_is_admin)], response_model=List[schemas.Mappool])
+async def sync_mappool(maps: List[schemas.Mappool], mappool_type: str = "QF", db: AsyncSession = Depends(get_db)):
+    return await crud.sync_mappool(db=db, mappool_type=mappool_type, maps=maps)
+
+
 @app.get("/mappool/team_scores", response_model=List[schemas.OverallTeamScore])
-async def get_mappool_team_scores(mappool_type: str = "QF", db: Session = Depends(get_db)):
-    maps = crud.get_team_scores_overall(db=db, mappool_type=mappool_type)
-    return maps
+async def get_mappool_team_scores(response: Response, mappool_type: str = "QF", db: AsyncSession = Depends(get_db)):
+    snapshot = await crud.get_team_standings(db=db, mappool_type=mappool_type)
+    if snapshot.version is not None:
+        response.headers["X-Standings-Version"] = str(snapshot.version)
+    return snapshot.rows
+
 
 @app.get("/mappool/player_scores", response_model=List[schemas.OverallPlayerScore])
-async def get_mappool_player_scores(mappool_type: str = "QF", db: Session = Depends(get_db)):
-    maps = crud.get_player_scores_overall(db=db, mappool_type=mappool_type)
-    return maps
+async def get_mappool_player_scores(response: Response, mappool_type: str = "QF",
+                                    db: AsyncSession = Depends(get_db)):
+    snapshot = await crud.get_player_standings(db=db, mappool_type=mappool_type)
+    if snapshot.version is not None:
+        response.headers["X-Standings-Version"] = str(snapshot.version)
+    return snapshot.rows
+
+
+@app.put("/mappool/team_scores", dependencies=[Depends(user_is_admin)], response_model=schemas.ScoreUpload)
+async def upload_mappool_team_scores(request: Request, content_type: str = Header(default="text/csv"),
+                                     db: AsyncSession = Depends(get_db)):
+    records = ingest.iter_records(request.stream(), content_type=content_type,
+                                  columns={"teamname": ingest.required_str,
+                                           "map_id": ingest.required_str,
+                                           "score": ingest.optional_int})
+    rows = await crud.replace_scores(db=db, table="team_scores", columns=["teamname", "map_id", "score"],
+                                     records=records)
+    return schemas.ScoreUpload(rows=rows)
+
+
+@app.put("/mappool/player_scores", dependencies=[Depends(user_is_admin)], response_model=schemas.ScoreUpload)
+async def upload_mappool_player_scores(request: Request, content_type: str = Header(default="text/csv"),
+                                       db: AsyncSession = Depends(get_db)):
+    records = ingest.iter_records(request.stream(), content_type=content_type,
+                                  columns={"username": ingest.required_str,
+                                           "map_id": ingest.required_str,
+                                           "score": ingest.optional_int})
+    rows = await crud.replace_scores(db=db, table="player_scores", columns=["username", "map_id", "score"],
+                                     records=records)
+    return schemas.ScoreUpload(rows=rows)
+
+
+@app.post("/mappool/scores/refresh", dependencies=[Depends(user_is_admin)], status_code=204)
+async def refresh_mappool_scores():
+    crud.refresh_standings()
+
+
+@app.post("/mappool/zscores", dependencies=[Depends(user_is_admin)], status_code=204)
+async def recompute_mappool_zscores(mappool_type: str = "QF", db: AsyncSession = Depends(get_db)):
+    await crud.recompute_mappool_zscores(db=db, mappool_type=mappool_type)
+
+
+@app.put("/team/scores", dependencies=[Depends(user_is_admin)], response_model=List[schemas.TeamMapScore])
+async def update_team_score(teamname: str, map_id: str, score: Optional[int] = None,
+                            db: AsyncSession = Depends(get_db)):
+    return await crud.update_team_score(db=db, teamname=teamname, map_id=map_id, score=score)
 
 
 @app.get("/team/scores", response_model=List[schemas.TeamMapScore])
-async def get_team_scores(map_id: str, db: Session = Depends(get_db)):
-    return crud.get_team_scores(db=db, map_id=map_id)
+async def get_team_scores(map_id: str, db: AsyncSession = Depends(get_read_db("scores"))):
+    return await crud.get_team_scores(db=db, map_id=map_id)
 
 
 @app.get("/user/scores", response_model=List[schemas.PlayerMapScore])
-async def get_player_scores(map_id: str, db: Session = Depends(get_db)):
-    return crud.get_player_scores(db=db, map_id=map_id)
+async def get_player_scores(map_id: str, db: AsyncSession = Depends(get_read_db("scores"))):
+    return await crud.get_player_scores(db=db, map_id=map_id)
+
+
+@app.get("/metrics", include_in_schema=False)
+def read_metrics(authorization: str | None = Header(default=None)):
+    metrics_token = os.getenv("METRICS_TOKEN")
+    if metrics_token and authorization != f"Bearer {metrics_token}":
+        raise HTTPException(401, "Invalid metrics token.")
+    content, media_type = metrics.render()
+    return Response(content=content, media_type=media_type)
+
+
+if os.getenv("DEV"):
+    @app.get("/debug/queries")
+    def read_query_profiles(n_plus_one: bool = False):
+        return [profile for profile in profiler.profiles if profile["n_plus_one"] or not n_plus_one]
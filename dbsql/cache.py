@@ -0,0 +1,196 @@
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, NamedTuple, Optional
+
+from utils import bus
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+_stores: Dict[str, "SnapshotStore"] = {}
+
+
+class Snapshot(NamedTuple):
+    # The shared ResourceVersions counter the rows were read at, or None while a bump is pending.
+    version: Optional[int]
+    rows: List[Any]
+
+
+class SnapshotStore:
+    def __init__(self, name: str):
+        self.name = name
+        # Counts this process' invalidations; only guards against storing stale rows.
+        self.generation = 0
+        self._snapshots = {}
+        _stores[name] = self
+
+    def get(self, key: Hashable, version: Optional[int]) -> Optional[Snapshot]:
+        snapshot = self._snapshots.get(key)
+        # Rows stamped with an older counter are stale even if the invalidation has not arrived yet.
+        if snapshot is None or snapshot.version != version:
+            return None
+        return snapshot
+
+    def set(self, key: Hashable, rows: List[Any], generation: int, version: Optional[int]) -> Snapshot:
+        snapshot = Snapshot(version=version, rows=rows)
+        # Rows computed before an invalidation, or without a known version, are served once but never stored.
+        if generation == self.generation and version is not None:
+            self._snapshots[key] = snapshot
+        return snapshot
+
+    def invalidate(self):
+        self.invalidate_local()
+        bus.send("snapshot", self.name)
+
+    def invalidate_local(self):
+        self.generation += 1
+        self._snapshots.clear()
+
+
+# The counters live in Postgres so every worker hands out the same tag for the same state. The
+# "epoch" row is set once per database, so tags never survive it being recreated.
+LOAD_VERSIONS = "SELECT name, version FROM resource_versions"
+BUMP_VERSIONS = ("INSERT INTO resource_versions (name, version) SELECT unnest($1::varchar[]), 1 "
+                 "ON CONFLICT (name) DO UPDATE SET version = resource_versions.version + 1 RETURNING name, version")
+
+
+class ResourceVersions:
+    def __init__(self, *names: str):
+        # Without the cache bus the counters stay in this process, and the random epoch keeps its
+        # tags from matching any other process.
+        self.epoch = uuid.uuid4().hex[:12]
+        self._versions = dict.fromkeys(names, 0)
+        # Bumps sent to Postgres and not answered yet. A resource with any gets no tag meanwhile,
+        # since its local counter could name a state another worker has tagged differently.
+        self._pending = dict.fromkeys(names, 0)
+        self._changed_at = dict.fromkeys(names, float("-inf"))
+
+    def bump(self, *names: str):
+        self._touch(names)
+        if bus.fetch(BUMP_VERSIONS, list(names), callback=self._bumped):
+            for name in names:
+                self._pending[name] += 1
+        else:
+            for name in names:
+                self._versions[name] += 1
+
+    def refresh(self):
+        # Loads the shared counters, on start-up and after the bus missed notifications.
+        self._touch(self._versions)
+        if bus.fetch(LOAD_VERSIONS, callback=self._loaded):
+            for name in self._pending:
+                self._pending[name] += 1
+
+    def apply(self, versions: Dict[str, int]):
+        self._touch(name for name in versions if name in self._versions)
+        self._merge(versions)
+
+    def _bumped(self, rows):
+        versions = {row["name"]: row["version"] for row in rows}
+        self._merge(versions)
+        for name in versions:
+            self._pending[name] -= 1
+        bus.send("versions", versions)
+
+    def _loaded(self, rows):
+        versions = {row["name"]: row["version"] for row in rows}
+        if "epoch" in versions:
+            self.epoch = format(versions["epoch"], "x")
+        self._merge(versions)
+        for name in self._pending:
+            self._pending[name] -= 1
+
+    def _merge(self, versions: Dict[str, int]):
+        for name, version in versions.items():
+            if name in self._versions:
+                self._versions[name] = max(self._versions[name], version)
+
+    def _touch(self, names):
+        now = time.monotonic()
+        for name in names:
+            self._changed_at[name] = now
+
+    def changed_within(self, seconds: float, *names: str) -> bool:
+        since = time.monotonic() - seconds
+        return any(self._changed_at[name] > since for name in names)
+
+    def version(self, name: str) -> Optional[int]:
+        if self._pending[name]:
+            return None
+        return self._versions[name]
+
+    def etag(self, *names: str) -> Optional[str]:
+        if any(self._pending[name] for name in names):
+            return None
+        return '"' + "-".join([self.epoch, *(str(self._versions[name]) for name in names)]) + '"'
+
+
+# Snapshots of schemas.User keyed by user_hash, used by the auth guards and /users/me.
+user_cache = TTLCache(maxsize=10000, ttl=30)
+
+# Qualifier standings keyed by (kind, mappool_type), rebuilt only after scores change.
+standings = SnapshotStore("standings")
+
+# Mappools keyed by mappool_type, rebuilt only after a mappool sync.
+mappools = SnapshotStore("mappools")
+
+# Change counters behind the ETags of the public read endpoints. "roster" covers users, teams and
+# their lobby assignments, "lobbies" the lobby rows themselves.
+versions = ResourceVersions("roster", "lobbies", "mappool", "scores")
+
+
+def _drop_users(*user_hashes: str):
+    for user_hash in user_hashes:
+        user_cache.pop(user_hash)
+
+
+def invalidate_users(*user_hashes: str):
+    _drop_users(*user_hashes)
+    # Batches too large for one notification clear the other workers' caches outright.
+    if not bus.send("users", *user_hashes):
+        bus.send("all_users")
+
+
+def _reset():
+    user_cache.clear()
+    for store in _stores.values():
+        store.invalidate_local()
+    versions.refresh()
+
+
+bus.register("users", _drop_users)
+bus.register("all_users", user_cache.clear)
+bus.register("snapshot", lambda name: _stores[name].invalidate_local())
+bus.register("versions", versions.apply)
+bus.on_reset(_reset)
@@ -1,331 +1,813 @@
 import datetime
-from typing import List, Optional
+import uuid
+from typing import AsyncIterable, List, Optional, Tuple
 
+import numpy as np
 import pytz
 from fastapi import HTTPException
-from sqlalchemy import func
-from sqlalchemy.orm import Session
+from sqlalchemy import (Interval, String, and_, bindparam, cast, delete, exists, func, insert, literal, or_, select,
+                        text, tuple_, update)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 
 from . import models, schemas
+from utils.events import LOBBIES_CHANNEL, broker, team_channel, user_channel
+from utils.zscore import compute_zscores
 
+from .cache import Snapshot, invalidate_users, mappools, standings, versions
+from .rows import LOBBY_COLUMNS, TEAM_COLUMNS, USER_COLUMNS, lobby_rows, players_by_team, team_rows, user_rows
 
-def get_user(db: Session, user_hash: str) -> models.User:
-    return db.query(models.User).filter(models.User.user_hash == user_hash).first()
+LOBBY_CAPACITY = 8
+TEAM_SIZE = 2
+# How long a claimed avatar job stays invisible to other workers before it counts as abandoned.
+AVATAR_JOB_LEASE = datetime.timedelta(minutes=2)
+# Hosted avatars remembered by content hash; the least recently used ones beyond the size, and
+# any not reused within the max age, are forgotten.
+AVATAR_CACHE_SIZE = 10000
+AVATAR_CACHE_MAX_AGE = datetime.timedelta(days=180)
 
+# Loader plans matching what the response schemas and write paths walk, so every
+# read loads its object graph in a fixed number of queries.
+USER_PLAN = (joinedload(models.User.team).selectinload(models.Team.players),)
+USER_LIST_PLAN = (joinedload(models.User.team),)
+TEAM_PLAN = (selectinload(models.Team.players),)
+INVITE_PLAN = (joinedload(models.Invite.team), joinedload(models.Invite.inviter), joinedload(models.Invite.invited))
+LOBBY_PLAN = (selectinload(models.QualifierLobby.teams).selectinload(models.Team.players),)
 
-def get_user_by_osu_id(db: Session, osu_id: int) -> models.User:
-    return db.query(models.User).filter(models.User.osu_id == osu_id).first()
 
+async def get_user(db: AsyncSession, user_hash: str) -> Optional[models.User]:
+    if user_hash is None:
+        return None
+    return await db.get(models.User, user_hash, options=USER_PLAN)
 
-def get_user_by_osu_username(db: Session, osu_username: str) -> models.User:
-    return db.query(models.User).filter(models.User.osu_username == osu_username).first()
 
+async def get_user_by_osu_id(db: AsyncSession, osu_id: int) -> models.User:
+    return await db.scalar(select(models.User).options(*USER_PLAN).where(models.User.osu_id == osu_id))
 
-def get_user_by_discord_id(db: Session, discord_id: str) -> models.User:
-    return db.query(models.User).filter(models.User.discord_id == discord_id).first()
 
+async def get_user_by_osu_username(db: AsyncSession, osu_username: str) -> models.User:
+    return await db.scalar(select(models.User).options(*USER_PLAN).where(
+        models.User.osu_username == osu_username))
 
-def get_users(db: Session) -> List[models.User]:
-    return db.query(models.User).order_by(func.lower(models.User.osu_username)).all()
 
+async def get_user_by_discord_id(db: AsyncSession, discord_id: str) -> models.User:
+    return await db.scalar(select(models.User).options(*USER_PLAN).where(
+        models.User.discord_id == discord_id))
 
-def get_user_invites(db: Session, user_hash: str) -> List[models.Invite]:
-    return db.query(models.Invite).filter(models.Invite.invited_user_hash == user_hash).all()
 
+def _users_page(query, after: Optional[List], limit: int, has_team: Optional[bool],
+                discord_linked: Optional[bool], is_banned: Optional[bool], in_lobby: Optional[bool]):
+    # osu_id breaks ties between equal lowercased names; user_hash is the login cookie, so it must
+    # never end up in a cursor.
+    sort_key = tuple_(func.lower(models.User.osu_username), models.User.osu_id)
+    query = query.order_by(*sort_key.clauses).limit(limit)
+    if after is not None:
+        osu_username, osu_id = after
+        query = query.where(sort_key > tuple_(func.lower(literal(osu_username)), literal(osu_id)))
+    if has_team is not None:
+        query = query.where(models.User.team_hash.isnot(None) if has_team else models.User.team_hash.is_(None))
+    if discord_linked is not None:
+        query = query.where(models.User.discord_linked.is_(discord_linked))
+    if is_banned is not None:
+        query = query.where(models.User.is_banned.is_(is_banned))
+    if in_lobby is not None:
+        team_in_lobby = models.User.team.has(models.Team.lobby_id.isnot(None))
+        query = query.where(team_in_lobby if in_lobby else ~team_in_lobby)
+    return query
 
-def get_team_invites(db: Session, team_hash: str) -> List[models.Invite]:
-    return db.query(models.Invite).filter(models.Invite.team_hash == team_hash).all()
 
+async def get_users(db: AsyncSession, after: Optional[List] = None, limit: int = 100,
+                    has_team: Optional[bool] = None, discord_linked: Optional[bool] = None,
+                    is_banned: Optional[bool] = None, in_lobby: Optional[bool] = None) -> List[models.User]:
+    query = _users_page(select(models.User).options(*USER_LIST_PLAN), after, limit, has_team, discord_linked,
+                        is_banned, in_lobby)
+    return (await db.scalars(query)).all()
 
-def get_lobbies(db: Session) -> List[models.QualifierLobby]:
-    return db.query(models.QualifierLobby).order_by(models.QualifierLobby.date).all()
 
+async def get_user_rows(db: AsyncSession, after: Optional[List] = None, limit: int = 100,
+                        has_team: Optional[bool] = None, discord_linked: Optional[bool] = None,
+                        is_banned: Optional[bool] = None,
+                        in_lobby: Optional[bool] = None) -> Tuple[List[dict], Optional[List]]:
+    query = select(*USER_COLUMNS, *TEAM_COLUMNS).select_from(models.User).outerjoin(
+        models.Team, models.User.team_hash == models.Team.team_hash)
+    query = _users_page(query, after, limit, has_team, discord_linked, is_banned, in_lobby)
+    result = (await db.execute(query)).all()
+    last = [result[-1].osu_username, result[-1].osu_id] if result else None
+    return user_rows(result), last
 
-def get_lobby_player_count(db: Session, lobby_id: int):
-    return db.query(models.Team).filter(models.Team.lobby_id == lobby_id).count()
 
+async def _players_by_team(db: AsyncSession, team_hashes: List[str]):
+    if not team_hashes:
+        return {}
+    return players_by_team(await db.execute(select(*USER_COLUMNS, models.User.team_hash).where(
+        models.User.team_hash.in_(team_hashes))))
 
-def get_teams(db: Session, skip: int = 0, limit: int = 100) -> List[models.Team]:
-    return db.query(models.Team).offset(skip).limit(limit).all()
 
+async def get_user_invites(db: AsyncSession, user_hash: str) -> List[models.Invite]:
+    return (await db.scalars(select(models.Invite).options(*INVITE_PLAN).where(
+        models.Invite.invited_user_hash == user_hash))).all()
 
-def get_team(db: Session, team_hash: str) -> models.Team:
-    return db.query(models.Team).filter(models.Team.team_hash == team_hash).first()
 
+async def get_team_invites(db: AsyncSession, team_hash: str) -> List[models.Invite]:
+    return (await db.scalars(select(models.Invite).options(*INVITE_PLAN).where(
+        models.Invite.team_hash == team_hash))).all()
 
-def count_teams(db: Session) -> int:
-    return db.query(models.Team).count()
 
+async def get_lobbies(db: AsyncSession) -> List[models.QualifierLobby]:
+    return (await db.scalars(select(models.QualifierLobby).options(*LOBBY_PLAN).order_by(
+        models.QualifierLobby.date))).all()
 
-def get_invite(db: Session, team_hash: str, user_hash: str) -> models.Invite:
-    return db.query(models.Invite).filter(
-        models.Invite.team_hash == team_hash, models.Invite.invited_user_hash == user_hash).first()
 
+async def get_lobby_rows(db: AsyncSession) -> List[dict]:
+    lobbies = (await db.execute(select(*LOBBY_COLUMNS).order_by(models.QualifierLobby.date))).all()
+    teams = (await db.execute(select(*TEAM_COLUMNS, models.Team.lobby_id).where(
+        models.Team.lobby_id.isnot(None)))).all()
+    players = await _players_by_team(db, [team.team_hash for team in teams])
+    return lobby_rows(lobbies, teams, players)
 
-def get_lobby(db: Session, lobby_id: int) -> models.QualifierLobby:
-    return db.query(models.QualifierLobby).filter(models.QualifierLobby.id == lobby_id).first()
 
+async def get_lobby_player_count(db: AsyncSession, lobby_id: int):
+    return await db.scalar(select(func.count()).select_from(models.Team).where(models.Team.lobby_id == lobby_id))
 
-def get_mappool(db: Session, mappool_type: str) -> List[models.Mappools]:
-    return db.query(models.Mappools).filter(models.Mappools.type == mappool_type.casefold()).all()
 
+def _teams_page(query, after: Optional[str], limit: int, in_lobby: Optional[bool]):
+    query = query.order_by(models.Team.title).limit(limit)
+    if after is not None:
+        query = query.where(models.Team.title > after)
+    if in_lobby is not None:
+        query = query.where(models.Team.lobby_id.isnot(None) if in_lobby else models.Team.lobby_id.is_(None))
+    return query
 
-def get_team_scores(db: Session, map_id: str) -> List[models.TeamScore]:
-    return db.query(models.TeamScore).filter(models.TeamScore.map_id == map_id,
-                                             models.TeamScore.score.isnot(None)).order_by(
-        models.TeamScore.score.desc()).all()
 
+async def get_teams(db: AsyncSession, after: Optional[str] = None, limit: int = 100,
+                    in_lobby: Optional[bool] = None) -> List[models.Team]:
+    query = _teams_page(select(models.Team).options(*TEAM_PLAN), after, limit, in_lobby)
+    return (await db.scalars(query)).all()
 
-def get_player_scores(db: Session, map_id: str) -> List[models.PlayerScore]:
-    return db.query(models.PlayerScore).filter(models.PlayerScore.map_id == map_id,
-                                               models.PlayerScore.score.isnot(None)).order_by(
-        models.PlayerScore.score.desc()).all()
 
+async def get_team_rows(db: AsyncSession, after: Optional[str] = None, limit: int = 100,
+                        in_lobby: Optional[bool] = None) -> List[dict]:
+    teams = (await db.execute(_teams_page(select(*TEAM_COLUMNS), after, limit, in_lobby))).all()
+    players = await _players_by_team(db, [team.team_hash for team in teams])
+    return team_rows(teams, players)
 
-def get_team_scores_overall(db: Session, mappool_type: str) -> List:
-    mappool = get_mappool(db=db, mappool_type=mappool_type)
+
+async def get_team(db: AsyncSession, team_hash: str) -> models.Team:
+    return await db.scalar(select(models.Team).options(*TEAM_PLAN).where(models.Team.team_hash == team_hash))
+
+
+async def count_teams(db: AsyncSession) -> int:
+    return await db.scalar(select(func.count()).select_from(models.Team))
+
+
+async def get_invite(db: AsyncSession, team_hash: str, user_hash: str) -> models.Invite:
+    return await db.scalar(select(models.Invite).options(*INVITE_PLAN).where(
+        models.Invite.team_hash == team_hash, models.Invite.invited_user_hash == user_hash))
+
+
+def _publish_invite(action: str, team_hash: str, invited_user_hash: str, invited_osu_id: int):
+    # user_hash is the login cookie, so events name players by osu_id.
+    for channel in (user_channel(invited_user_hash), team_channel(team_hash)):
+        broker.publish(channel, "invite", action=action, team_hash=team_hash, invited_osu_id=invited_osu_id)
+
+
+async def get_lobby(db: AsyncSession, lobby_id: int) -> models.QualifierLobby:
+    return await db.scalar(select(models.QualifierLobby).options(*LOBBY_PLAN).where(
+        models.QualifierLobby.id == lobby_id))
+
+
+async def get_mappool(db: AsyncSession, mappool_type: str) -> List[schemas.Mappool]:
+    mappool_type = mappool_type.casefold()
+    generation, version = mappools.generation, versions.version("mappool")
+    snapshot = mappools.get(mappool_type, version)
+    if snapshot is None:
+        db_maps = (await db.scalars(select(models.Mappools).where(models.Mappools.type == mappool_type))).all()
+        snapshot = mappools.set(mappool_type, [schemas.Mappool.from_orm(db_map) for db_map in db_maps],
+                                generation, version)
+    return snapshot.rows
+
+
+async def get_team_scores(db: AsyncSession, map_id: str) -> List[models.TeamScore]:
+    return (await db.scalars(select(models.TeamScore).where(models.TeamScore.map_id == map_id,
+                                                            models.TeamScore.score.isnot(None)).order_by(
+        models.TeamScore.score.desc()))).all()
+
+
+async def get_player_scores(db: AsyncSession, map_id: str) -> List[models.PlayerScore]:
+    return (await db.scalars(select(models.PlayerScore).where(models.PlayerScore.map_id == map_id,
+                                                              models.PlayerScore.score.isnot(None)).order_by(
+        models.PlayerScore.score.desc()))).all()
+
+
+async def get_team_scores_overall(db: AsyncSession, mappool_type: str) -> List:
+    mappool = await get_mappool(db=db, mappool_type=mappool_type)
     map_ids = [map.id for map in mappool]
-    return db.query(models.TeamScore.teamname, func.sum(models.TeamScore.score).label("score"),
-                    func.sum(models.TeamScore.zscore).label("zscore")).filter(
+    return (await db.execute(select(models.TeamScore.teamname, func.sum(models.TeamScore.score).label("score"),
+                                    func.sum(models.TeamScore.zscore).label("zscore")).where(
         models.TeamScore.map_id.in_(map_ids), models.TeamScore.zscore.isnot(None)).group_by(
-        models.TeamScore.teamname, models.TeamScore.teamname).order_by(func.sum(models.TeamScore.zscore).desc()).all()
+        models.TeamScore.teamname).order_by(func.sum(models.TeamScore.zscore).desc()))).all()
 
 
-def get_player_scores_overall(db: Session, mappool_type: str) -> List[models.TeamScore]:
-    mappool = get_mappool(db=db, mappool_type=mappool_type)
+async def get_player_scores_overall(db: AsyncSession, mappool_type: str) -> List:
+    mappool = await get_mappool(db=db, mappool_type=mappool_type)
     map_ids = [map.id for map in mappool]
-    return db.query(models.PlayerScore.username, func.sum(models.PlayerScore.score).label("score")).filter(
+    return (await db.execute(select(models.PlayerScore.username,
+                                    func.sum(models.PlayerScore.score).label("score")).where(
         models.PlayerScore.map_id.in_(map_ids), models.PlayerScore.score.isnot(None)).group_by(
-        models.PlayerScore.username).order_by(func.sum(models.PlayerScore.score).desc()).all()
-
-
-def create_osu_user(db: Session, user: schemas.OsuUserCreate) -> models.User:
-    db_user = models.User(**user.dict(), osu_linked=True)
+        models.PlayerScore.username).order_by(func.sum(models.PlayerScore.score).desc()))).all()
+
+
+async def get_team_standings(db: AsyncSession, mappool_type: str) -> Snapshot:
+    key = ("team", mappool_type.casefold())
+    generation, version = standings.generation, versions.version("scores")
+    snapshot = standings.get(key, version)
+    if snapshot is None:
+        rows = await get_team_scores_overall(db=db, mappool_type=mappool_type)
+        snapshot = standings.set(key, [schemas.OverallTeamScore.from_orm(row) for row in rows], generation, version)
+    return snapshot
+
+
+async def get_player_standings(db: AsyncSession, mappool_type: str) -> Snapshot:
+    key = ("player", mappool_type.casefold())
+    generation, version = standings.generation, versions.version("scores")
+    snapshot = standings.get(key, version)
+    if snapshot is None:
+        rows = await get_player_scores_overall(db=db, mappool_type=mappool_type)
+        snapshot = standings.set(key, [schemas.OverallPlayerScore.from_orm(row) for row in rows], generation, version)
+    return snapshot
+
+
+def refresh_standings():
+    standings.invalidate()
+    versions.bump("scores")
+
+
+async def recompute_team_zscores(db: AsyncSession, map_ids: Optional[List[str]] = None):
+    query = select(models.TeamScore.index, models.TeamScore.map_id, models.TeamScore.score)
+    if map_ids is not None:
+        query = query.where(models.TeamScore.map_id.in_(map_ids))
+    rows = (await db.execute(query)).all()
+    if not rows:
+        return
+
+    indexes, row_map_ids, scores = zip(*rows)
+    _, groups = np.unique(np.array(row_map_ids, dtype=object), return_inverse=True)
+    zscores = compute_zscores(groups, np.array(scores, dtype=np.float64))
+
+    table = models.TeamScore.__table__
+    await db.execute(update(table).where(table.c.index == bindparam("b_index")).values(
+        zscore=bindparam("b_zscore")), [{"b_index": index, "b_zscore": None if np.isnan(zscore) else float(zscore)}
+                                        for index, zscore in zip(indexes, zscores)])
+
+
+async def recompute_mappool_zscores(db: AsyncSession, mappool_type: str):
+    mappool = await get_mappool(db=db, mappool_type=mappool_type)
+    await recompute_team_zscores(db=db, map_ids=[map.id for map in mappool])
+    await db.commit()
+    standings.invalidate()
+    versions.bump("scores")
+
+
+async def update_team_score(db: AsyncSession, teamname: str, map_id: str,
+                            score: Optional[int]) -> List[models.TeamScore]:
+    db_score = await db.scalar(select(models.TeamScore).where(models.TeamScore.teamname == teamname,
+                                                             models.TeamScore.map_id == map_id))
+    if db_score is None:
+        raise HTTPException(404, "Score not found.")
+    db_score.score = score
+    await db.flush()
+
+    await recompute_team_zscores(db=db, map_ids=[map_id])
+    await db.commit()
+    db.expire(db_score)
+    standings.invalidate()
+    versions.bump("scores")
+    return await get_team_scores(db=db, map_id=map_id)
+
+
+async def replace_scores(db: AsyncSession, table: str, columns: List[str], records: AsyncIterable[tuple]) -> int:
+    # records are (line number, *columns) as produced by utils.ingest.iter_records.
+    staging = f"{table}_staging"
+    column_list = ", ".join(columns)
+    # Runs through the session first so the raw COPY below joins the same transaction.
+    await db.execute(text(f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+                          f"SELECT 0 AS line, {column_list} FROM {table} WITH NO DATA"))
+
+    connection = await db.connection()
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(staging, records=records, columns=["line", *columns])
+
+    # Names that match no team or user would fail the foreign keys below; report them by line instead.
+    for column in columns:
+        for foreign_key in models.Base.metadata.tables[table].c[column].foreign_keys:
+            target = foreign_key.column
+            unknown = (await db.execute(text(
+                f"SELECT line, {column} FROM {staging} WHERE {column} IS NOT NULL AND NOT EXISTS "
+                f"(SELECT 1 FROM {target.table.name} WHERE {target.name} = {staging}.{column}) "
+                f"ORDER BY line LIMIT 10"))).all()
+            if unknown:
+                await db.rollback()
+                raise HTTPException(400, f"Unknown {column}: " +
+                                    ", ".join(f"{value!r} (line {line})" for line, value in unknown))
+
+    # Readers keep seeing the previous rows until this transaction commits.
+    await db.execute(text(f"DELETE FROM {table}"))
+    try:
+        result = await db.execute(text(f'INSERT INTO {table} ("index", {column_list}) '
+                                       f'SELECT row_number() OVER (ORDER BY line) - 1, {column_list} '
+                                       f'FROM {staging}'))
+    except IntegrityError as e:
+        # A team or user renamed between the check above and the insert; asyncpg's detail names the key.
+        await db.rollback()
+        raise HTTPException(400, getattr(e.orig.__cause__, "detail", None) or "Upload references an unknown key.")
+    if table == models.TeamScore.__tablename__:
+        await recompute_team_zscores(db=db)
+    await db.commit()
+    standings.invalidate()
+    versions.bump("scores")
+    return result.rowcount
+
+
+def _mappool_row(map: schemas.Mappool, **extra) -> dict:
+    row = {}
+    for key, value in {**map.dict(), **extra}.items():
+        column = models.Mappools.__mapper__.columns[key]
+        if isinstance(column.type, String) and value is not None:
+            value = map._source_text.get(key, str(value))
+        row[column.key] = value
+    return row
+
+
+async def sync_mappool(db: AsyncSession, mappool_type: str, maps: List[schemas.Mappool]) -> List[schemas.Mappool]:
+    mappool_type = mappool_type.casefold()
+    table = models.Mappools.__table__
+    # Serializes syncs, so two never diff against the same rows or hand out the same max(_id) + 1.
+    # Readers are not blocked.
+    await db.execute(text(f"LOCK TABLE {table.name} IN SHARE ROW EXCLUSIVE MODE"))
+    db_maps = (await db.scalars(select(models.Mappools).where(models.Mappools.type == mappool_type))).all()
+    existing = {db_map.id: db_map for db_map in db_maps}
+    incoming = {map.id: map for map in maps}
+
+    inserts, updates = [], []
+    for map_id, map in incoming.items():
+        db_map = existing.get(map_id)
+        if db_map is None:
+            inserts.append(_mappool_row(map, type=mappool_type))
+        elif schemas.Mappool.from_orm(db_map) != map:
+            updates.append({f"b_{key}": value for key, value in _mappool_row(map).items()} |
+                           {"b__id": db_map._id})
+    removed_ids = [db_map._id for map_id, db_map in existing.items() if map_id not in incoming]
+
+    if removed_ids:
+        await db.execute(delete(table).where(table.c._id.in_(removed_ids)))
+    if updates:
+        columns = [models.Mappools.__mapper__.columns[key] for key in schemas.Mappool.__fields__]
+        await db.execute(update(table).where(table.c._id == bindparam("b__id")).values(
+            {column: bindparam(f"b_{column.key}") for column in columns}), updates)
+    if inserts:
+        max_id = await db.scalar(select(func.max(table.c._id)))
+        next_id = 0 if max_id is None else max_id + 1
+        await db.execute(insert(table), [{**row, "_id": next_id + i} for i, row in enumerate(inserts)])
+    await db.commit()
+
+    for db_map in db_maps:
+        db.expire(db_map)
+    mappools.invalidate()
+    versions.bump("mappool")
+    standings.invalidate()
+    versions.bump("scores")
+    return await get_mappool(db=db, mappool_type=mappool_type)
+
+
+async def create_osu_user(db: AsyncSession, user: schemas.OsuUserCreate) -> models.User:
+    db_user = models.User(**user.dict(), osu_linked=True, team=None)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    versions.bump("roster")
     return db_user
 
 
-def leave_team(db: Session, user_hash: str) -> models.User:
-    db_user = get_user(db=db, user_hash=user_hash)
-    if not db_user.team:
-        raise HTTPException(400, "User is not in a team")
+async def get_osu_profiles(db: AsyncSession):
+    return (await db.execute(select(models.User.user_hash, models.User.osu_id, models.User.osu_avatar_url,
+                                    models.User.osu_global_rank, models.User.badges, models.User.bws_rank).where(
+        models.User.osu_id.isnot(None)))).all()
 
-    db_team = get_team(db=db, team_hash=db_user.team_hash)
-    if len(db_team.players) == 1:
-        db_team_invites = get_team_invites(db=db, team_hash=db_team.team_hash)
 
-        for invite in db_team_invites:
-            db.delete(invite)
+async def update_osu_profiles(db: AsyncSession, profiles: List[dict]):
+    # osu_username is left alone: player_scores references it without ON UPDATE CASCADE.
+    if not profiles:
+        return
 
-        db.delete(db_team)
-    else:
-        db_user.team_hash = None
+    table = models.User.__table__
+    await db.execute(update(table).where(table.c.user_hash == bindparam("b_user_hash")).values(
+        osu_avatar_url=bindparam("b_osu_avatar_url"), osu_global_rank=bindparam("b_osu_global_rank"),
+        badges=bindparam("b_badges"), bws_rank=bindparam("b_bws_rank")),
+        [{f"b_{name}": value for name, value in profile.items()} for profile in profiles])
+    await db.commit()
+    invalidate_users(*(profile["user_hash"] for profile in profiles))
+    versions.bump("roster")
 
-    db.commit()
-    db.refresh(db_user)
-    return db_user
 
+async def leave_team(db: AsyncSession, db_user: models.User) -> models.User:
+    if not db_user.team:
+        raise HTTPException(400, "User is not in a team")
 
-def upgrade_to_discord_user(db: Session, user_hash: str, user: schemas.DiscordUser) -> models.User:
-    db_user = get_user(db=db, user_hash=user_hash)
+    team_hash = db_user.team_hash
+    users, teams, invites = models.User.__table__, models.Team.__table__, models.Invite.__table__
+    # Locking the team row serializes the players leaving it, so whoever leaves last sees the team
+    # empty and disbands it.
+    locked = select(teams.c.team_hash).where(teams.c.team_hash == team_hash).with_for_update().cte("locked")
+    left = await db.scalar(update(users).where(users.c.user_hash == db_user.user_hash,
+                                               users.c.team_hash.in_(select(locked.c.team_hash))).values(
+        team_hash=None).returning(users.c.user_hash))
+    if left is None:
+        raise HTTPException(400, "User is not in a team")
 
+    empty = ~exists().where(users.c.team_hash == team_hash)
+    cleared = delete(invites).where(invites.c.team_hash == team_hash, empty).cte("cleared")
+    disbanded = (await db.execute(delete(teams).where(teams.c.team_hash == team_hash, empty).returning(
+        teams.c.lobby_id).add_cte(cleared))).first()
+    await db.commit()
+
+    set_committed_value(db_user, "team_hash", None)
+    set_committed_value(db_user, "team", None)
+    invalidate_users(db_user.user_hash)
+    versions.bump("roster")
+    broker.publish(team_channel(team_hash), "team", action="leave", osu_id=db_user.osu_id)
+    if disbanded is not None and disbanded.lobby_id is not None:
+        broker.publish(LOBBIES_CHANNEL, "lobby", action="leave", lobby_id=disbanded.lobby_id, team_hash=team_hash)
+    return db_user
+
+
+async def upgrade_to_discord_user(db: AsyncSession, db_user: models.User, user: schemas.DiscordUser) -> models.User:
     db_user.discord_id = user.discord_id
     db_user.discord_tag = user.discord_tag
     db_user.discord_avatar_url = user.discord_avatar_url
     db_user.discord_linked = True
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    invalidate_users(db_user.user_hash)
+    versions.bump("roster")
     return db_user
 
 
-def downgrade_from_discord_user(db: Session, user_hash: str) -> models.User:
-    db_user = get_user(db=db, user_hash=user_hash)
-
+async def downgrade_from_discord_user(db: AsyncSession, db_user: models.User) -> models.User:
     db_user.discord_id = None
     db_user.discord_tag = None
     db_user.discord_avatar_url = None
     db_user.discord_linked = False
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    invalidate_users(db_user.user_hash)
+    versions.bump("roster")
     return db_user
 
 
-def create_team(db: Session, team: schemas.TeamCreate, user_hash: str, team_hash: str) -> Optional[models.Team]:
-    db_user = get_user(db=db, user_hash=user_hash)
+async def create_team(db: AsyncSession, team: schemas.TeamCreate, db_user: models.User,
+                      team_hash: str) -> Optional[models.Team]:
     if db_user.team_hash:
         raise HTTPException(400, "User is already on a team.")
-    db_user_invites = get_user_invites(db=db, user_hash=user_hash)
-    db_team = models.Team(**team.dict(), team_hash=team_hash)
-    for db_invite in db_user_invites:
-        db.delete(db_invite)
-    db.add(db_team)
-    db.commit()
-    db.refresh(db_team)
-    db_user.team_hash = db_team.team_hash
-    db.commit()
+
+    users, teams, invites = models.User.__table__, models.Team.__table__, models.Invite.__table__
+    db_team = await db.scalar(select(models.Team).from_statement(pg_insert(teams).values(
+        **team.dict(), team_hash=team_hash).on_conflict_do_nothing(index_elements=[teams.c.title]).returning(*teams.c)))
+    if db_team is None:
+        raise HTTPException(400, "A team with this name already exists.")
+
+    # The conditional update also stops a concurrent create or join for the same user.
+    cleared = delete(invites).where(invites.c.invited_user_hash == db_user.user_hash).cte("cleared")
+    joined = await db.scalar(update(users).where(users.c.user_hash == db_user.user_hash,
+                                                 users.c.team_hash.is_(None)).values(
+        team_hash=team_hash).returning(users.c.user_hash).add_cte(cleared))
+    if joined is None:
+        raise HTTPException(400, "User is already on a team.")
+    await db.commit()
+
+    set_committed_value(db_user, "team_hash", team_hash)
+    set_committed_value(db_user, "team", db_team)
+    set_committed_value(db_team, "players", [db_user])
+    invalidate_users(db_user.user_hash)
+    versions.bump("roster")
     return db_team
 
 
-def add_player_to_team(db: Session, team_hash: str, user_hash: str):
-    db_invite = get_invite(db=db, team_hash=team_hash, user_hash=user_hash)
-    if not db_invite:
-        raise HTTPException(400, "This invite is for someone else.")
+async def add_player_to_team(db: AsyncSession, team_hash: str, db_user: models.User):
+    if db_user.team_hash:
+        raise HTTPException(400, "User is already on a team.")
 
-    db_user = get_user(db=db, user_hash=user_hash)
-    db_team = get_team(db=db, team_hash=team_hash)
-    db_user.team_hash = db_team.team_hash
+    # Locking the team row serializes joins per team; the player count below runs in a later
+    # statement, so it sees the player added by the previous lock holder.
+    db_team = await db.scalar(select(models.Team).where(models.Team.team_hash == team_hash).with_for_update())
+    if db_team is None:
+        raise HTTPException(400, "This invite is for someone else.")
 
-    # Delete all the team invites if someone joins the team
-    db.query(models.Invite).filter(models.Invite.team_hash == team_hash).delete()
-    db.commit()
-    db.refresh(db_user)
+    # Joining uses up every invite of the team, and only succeeds if one of them was this user's.
+    users, invites = models.User.__table__, models.Invite.__table__
+    claimed = delete(invites).where(invites.c.team_hash == team_hash).returning(
+        invites.c.invited_user_hash).cte("claimed")
+    players = select(func.count()).where(users.c.team_hash == team_hash).scalar_subquery()
+    invited_user_hashes = await db.scalar(update(users).where(
+        users.c.user_hash == db_user.user_hash, users.c.team_hash.is_(None),
+        users.c.user_hash.in_(select(claimed.c.invited_user_hash)), players < TEAM_SIZE).values(
+        team_hash=team_hash).returning(select(func.array_agg(claimed.c.invited_user_hash)).scalar_subquery()))
+    if invited_user_hashes is None:
+        raise HTTPException(400, "This invite is for someone else.")
+    await db.commit()
+
+    set_committed_value(db_user, "team_hash", team_hash)
+    set_committed_value(db_user, "team", db_team)
+    invalidate_users(db_user.user_hash)
+    versions.bump("roster")
+    broker.publish(team_channel(team_hash), "team", action="join", osu_id=db_user.osu_id)
+    for invited_user_hash in invited_user_hashes:
+        broker.publish(user_channel(invited_user_hash), "invite", action="removed", team_hash=team_hash)
     return db_user
 
 
-def create_invite(db: Session, invited_user_osu_id: int, team_owner_hash: str):
-    team_owner = get_user(db=db, user_hash=team_owner_hash)
+async def create_invite(db: AsyncSession, invited_user_osu_id: int, team_owner: models.User):
     if not team_owner.team_hash:
         raise HTTPException(400, "You do not have a team yet.")
-    team = get_team(db=db, team_hash=team_owner.team_hash)
-    invited_user = get_user_by_osu_id(db=db, osu_id=invited_user_osu_id)
-    db_invite = get_invite(db=db, team_hash=team.team_hash, user_hash=invited_user.user_hash)
+    team = team_owner.team
+    if len(team.players) >= TEAM_SIZE:
+        raise HTTPException(400, "The team is already full.")
 
-    if db_invite:
-        raise HTTPException(400, "User is already invited.")
-    if not invited_user:
+    # Locking the team row serializes invites and joins per team, so the insert below, a later
+    # statement, sees everything the previous lock holder committed.
+    users, invites = models.User.__table__, models.Invite.__table__
+    already_invited = exists().where(invites.c.team_hash == team.team_hash,
+                                     invites.c.invited_user_hash == models.User.user_hash)
+    row = (await db.execute(select(models.User, already_invited.label("already_invited")).join(
+        models.Team, models.Team.team_hash == team.team_hash).where(
+        models.User.osu_id == invited_user_osu_id).with_for_update(of=models.Team))).first()
+    if row is None:
         raise HTTPException(400, "Invited user has not signed-up yet.")
-    if invited_user.user_hash == team_owner_hash:
+    invited_user = row.User
+    if row.already_invited:
+        raise HTTPException(400, "User is already invited.")
+    if invited_user.user_hash == team_owner.user_hash:
         raise HTTPException(400, "The team owner does not match the current user.")
-    if len(team.players) > 1:
-        raise HTTPException(400, "The team is already full.")
 
-    db_invite = models.Invite(team_hash=team_owner.team_hash, invited_user_hash=invited_user.user_hash,
-                              inviter_user_hash=team_owner.user_hash)
-    db.add(db_invite)
-    db.commit()
-    db.refresh(db_invite)
-    return db_invite
+    duplicate = exists().where(invites.c.team_hash == team.team_hash,
+                               invites.c.invited_user_hash == invited_user.user_hash)
+    players = select(func.count()).where(users.c.team_hash == team.team_hash).scalar_subquery()
+    invite_id = await db.scalar(insert(invites).from_select(
+        ["invited_user_hash", "inviter_user_hash", "team_hash"],
+        select(literal(invited_user.user_hash), literal(team_owner.user_hash), literal(team.team_hash)).where(
+            ~duplicate, players < TEAM_SIZE)).returning(invites.c.id))
+    if invite_id is None:
+        raise HTTPException(400, "User is already invited or the team is full.")
+    await db.commit()
+
+    _publish_invite("created", team_hash=team.team_hash, invited_user_hash=invited_user.user_hash,
+                    invited_osu_id=invited_user.osu_id)
+    return models.Invite(id=invite_id, team=team, invited=invited_user, inviter=team_owner)
+
+
+async def find_cached_avatar(db: AsyncSession, *hashes: str) -> Optional[str]:
+    cache = models.AvatarCache.__table__
+    return (await db.execute(update(cache).where(cache.c.hash.in_(hashes)).values(
+        last_used_at=func.now()).returning(cache.c.avatar_url))).scalars().first()
+
+
+async def _remember_avatar(db: AsyncSession, hashes: List[str], img_url: str):
+    if not hashes:
+        return
+
+    cache = models.AvatarCache.__table__
+    await db.execute(pg_insert(cache).values([{"hash": avatar_hash, "avatar_url": img_url}
+                                              for avatar_hash in hashes]).on_conflict_do_update(
+        index_elements=[cache.c.hash], set_={"avatar_url": img_url, "last_used_at": func.now()}))
+    cutoff = select(cache.c.last_used_at).order_by(cache.c.last_used_at.desc()).offset(
+        AVATAR_CACHE_SIZE).limit(1).scalar_subquery()
+    await db.execute(delete(cache).where(or_(cache.c.last_used_at <= cutoff,
+                                             cache.c.last_used_at < func.now() - cast(AVATAR_CACHE_MAX_AGE, Interval))))
+
 
+async def _set_team_avatar(db: AsyncSession, team_hash: str, img_url: str) -> List[str]:
+    await db.execute(update(models.Team.__table__).where(models.Team.team_hash == team_hash).values(
+        avatar_url=img_url))
+    return (await db.scalars(select(models.User.user_hash).where(models.User.team_hash == team_hash))).all()
 
-def create_avatar(db: Session, user_hash: str, img_url: str):
-    db_user = get_user(db=db, user_hash=user_hash)
+
+def _team_avatar_changed(team_hash: str, img_url: str, player_hashes: List[str]):
+    invalidate_users(*player_hashes)
+    versions.bump("roster")
+    broker.publish(team_channel(team_hash), "team", action="avatar", avatar_url=img_url)
+
+
+async def create_avatar_job(db: AsyncSession, db_user: models.User, source_hash: str, pixel_hash: Optional[str] = None,
+                            image: Optional[bytes] = None, img_url: Optional[str] = None) -> models.AvatarJob:
     if not db_user.team_hash:
         raise HTTPException(400, "User does not belong to a team.")
 
-    db_team = get_team(db=db, team_hash=db_user.team_hash)
-    db_team.avatar_url = img_url
-    db.commit()
-    db.refresh(db_team)
-    return db_team
+    db_job = models.AvatarJob(id=uuid.uuid4().hex, team_hash=db_user.team_hash, attempts=0,
+                              source_hash=source_hash, pixel_hash=pixel_hash)
+    if img_url is None:
+        db_job.status = "pending"
+        db_job.image = image
+        db.add(db_job)
+        await db.commit()
+        return db_job
+
+    # Already hosted: finish the job right away, and remember this exact file too if it only
+    # matched by pixels.
+    db_job.status = "done"
+    db_job.avatar_url = img_url
+    db.add(db_job)
+    await _remember_avatar(db, hashes=[source_hash], img_url=img_url)
+    player_hashes = await _set_team_avatar(db, team_hash=db_user.team_hash, img_url=img_url)
+    await db.commit()
+    _team_avatar_changed(db_user.team_hash, img_url, player_hashes)
+    return db_job
+
+
+async def get_avatar_job(db: AsyncSession, job_id: str, team_hash: str) -> Optional[models.AvatarJob]:
+    return await db.scalar(select(models.AvatarJob).where(models.AvatarJob.id == job_id,
+                                                          models.AvatarJob.team_hash == team_hash))
+
+
+async def claim_avatar_job(db: AsyncSession, max_attempts: int):
+    # SKIP LOCKED lets every worker in every process claim a different job. Claiming pushes run_at
+    # out by the lease, so a job whose worker died is picked up again once the lease runs out, and
+    # failed for good once it has used up its attempts that way.
+    jobs = models.AvatarJob.__table__
+    abandoned = and_(jobs.c.status == "uploading", jobs.c.run_at <= func.now(), jobs.c.attempts >= max_attempts)
+    exhausted = update(jobs).where(abandoned).values(
+        status="failed", image=None, error="The upload was interrupted too many times.").cte("exhausted")
+    due = select(jobs.c.id).where(jobs.c.status.in_(("pending", "uploading")), jobs.c.run_at <= func.now(),
+                                  ~abandoned).order_by(
+        jobs.c.run_at).limit(1).with_for_update(skip_locked=True).scalar_subquery()
+    job = (await db.execute(update(jobs).where(jobs.c.id == due).values(
+        status="uploading", attempts=jobs.c.attempts + 1,
+        run_at=func.now() + cast(AVATAR_JOB_LEASE, Interval)).returning(
+        jobs.c.id, jobs.c.team_hash, jobs.c.image, jobs.c.attempts, jobs.c.source_hash,
+        jobs.c.pixel_hash).add_cte(exhausted))).first()
+    await db.commit()
+    return job
+
+
+async def complete_avatar_job(db: AsyncSession, job_id: str, team_hash: str, img_url: str, hashes: List[str]):
+    jobs = models.AvatarJob.__table__
+    await db.execute(update(jobs).where(jobs.c.id == job_id).values(
+        status="done", avatar_url=img_url, image=None, error=None))
+    await _remember_avatar(db, hashes=[avatar_hash for avatar_hash in hashes if avatar_hash], img_url=img_url)
+    player_hashes = await _set_team_avatar(db, team_hash=team_hash, img_url=img_url)
+    await db.commit()
+    _team_avatar_changed(team_hash, img_url, player_hashes)
+
+
+async def retry_avatar_job(db: AsyncSession, job_id: str, error: str, delay: Optional[datetime.timedelta]):
+    jobs = models.AvatarJob.__table__
+    if delay is None:
+        values = dict(status="failed", image=None, error=error)
+    else:
+        values = dict(status="pending", error=error, run_at=func.now() + cast(delay, Interval))
+    await db.execute(update(jobs).where(jobs.c.id == job_id).values(**values))
+    await db.commit()
 
 
-def add_team_to_lobby(db: Session, user_hash: str, lobby_id: int):
-    lobby_teams = get_lobby_player_count(db=db, lobby_id=lobby_id)
-    if lobby_teams == 8:
-        raise HTTPException(401, "Lobby is full!")
+async def add_team_to_lobby(db: AsyncSession, db_user: models.User, lobby_id: int) -> Tuple[models.Team, int]:
+    db_team = db_user.team
+    if db_team is None:
+        raise HTTPException(401, "You are not in a team.")
+    if len(db_team.players) < TEAM_SIZE:
+        raise HTTPException(401, "Your team is incomplete.")
 
-    db_lobby = get_lobby(db=db, lobby_id=lobby_id)
+    # Locking the lobby row serializes concurrent joins per lobby; the count below runs in a
+    # later statement, so it sees every team committed by the previous lock holder.
+    lobby_date = await db.scalar(select(models.QualifierLobby.date).where(
+        models.QualifierLobby.id == lobby_id).with_for_update())
+    if lobby_date is None:
+        raise HTTPException(401, "Selected lobby does not exist.")
 
     time_now = datetime.datetime.utcnow()
     time_now_utc = pytz.utc.localize(time_now)
     timezone = pytz.timezone("Asia/Singapore")
     time_now_in_singapore = timezone.normalize(time_now_utc)
-    lobby_date = timezone.localize(db_lobby.date)
+    lobby_date = timezone.localize(lobby_date)
     lobby_expire = lobby_date - datetime.timedelta(minutes=30)
 
     if lobby_expire < time_now_in_singapore:
         raise HTTPException(401, "Lobby is closed.")
 
-    db_user = get_user(db=db, user_hash=user_hash)
-    db_team = get_team(db=db, team_hash=db_user.team_hash)
-    if db_team is None:
-        raise HTTPException(401, "You are not in a team.")
-    if len(db_team.players) < 2:
-        raise HTTPException(401, "Your team is incomplete.")
-    db_team.lobby_id = lobby_id
-    db.commit()
-    db.refresh(db_team)
-    return db_team
+    teams = models.Team.__table__
+    other_teams = select(func.count()).where(teams.c.lobby_id == lobby_id,
+                                             teams.c.team_hash != db_team.team_hash).scalar_subquery()
+    occupancy = await db.scalar(update(teams).where(teams.c.team_hash == db_team.team_hash,
+                                                    other_teams < LOBBY_CAPACITY).values(
+        lobby_id=lobby_id).returning(other_teams + 1))
+    if occupancy is None:
+        raise HTTPException(401, "Lobby is full!")
 
+    await db.commit()
+    versions.bump("roster")
+    set_committed_value(db_team, "lobby_id", lobby_id)
+    broker.publish(LOBBIES_CHANNEL, "lobby", action="join", lobby_id=lobby_id, team_hash=db_team.team_hash,
+                   occupancy=occupancy)
+    return db_team, occupancy
 
-def remove_team_from_lobby(db: Session, user_hash: str):
-    db_user = get_user(db=db, user_hash=user_hash)
-    db_team = get_team(db=db, team_hash=db_user.team_hash)
+
+async def remove_team_from_lobby(db: AsyncSession, db_user: models.User):
+    db_team = db_user.team
+    lobby_id = db_team.lobby_id
     db_team.lobby_id = None
-    db.commit()
-    db.refresh(db_team)
+    await db.commit()
+    versions.bump("roster")
+    if lobby_id is not None:
+        broker.publish(LOBBIES_CHANNEL, "lobby", action="leave", lobby_id=lobby_id, team_hash=db_team.team_hash)
     return db_team
 
 
-def decline_invite(db: Session, user_hash: str, team_hash: str):
-    db_invite = get_invite(db=db, user_hash=user_hash, team_hash=team_hash)
-    if not db_invite:
+async def decline_invite(db: AsyncSession, db_user: models.User, team_hash: str):
+    invite_id = await db.scalar(delete(models.Invite).where(
+        models.Invite.team_hash == team_hash, models.Invite.invited_user_hash == db_user.user_hash).returning(
+        models.Invite.id))
+    if invite_id is None:
         raise HTTPException(400, "You do not have an invite to decline.")
-    db.delete(db_invite)
-    db.commit()
-    return get_user(db=db, user_hash=user_hash)
+    await db.commit()
+    _publish_invite("declined", team_hash=team_hash, invited_user_hash=db_user.user_hash, invited_osu_id=db_user.osu_id)
+    return db_user
 
 
-def cancel_invite(db: Session, user_hash: str, invited_user_osu_id: int):
-    inviter_user = get_user(db=db, user_hash=user_hash)
-    invited_user = get_user_by_osu_id(db=db, osu_id=invited_user_osu_id)
-    db_invite = get_invite(db=db, team_hash=inviter_user.team_hash, user_hash=invited_user.user_hash)
-    if not db_invite:
+async def cancel_invite(db: AsyncSession, inviter_user: models.User, invited_user_osu_id: int):
+    users, invites = models.User.__table__, models.Invite.__table__
+    invited_user_hash = await db.scalar(delete(invites).where(
+        invites.c.team_hash == inviter_user.team_hash, invites.c.invited_user_hash == users.c.user_hash,
+        users.c.osu_id == invited_user_osu_id).returning(invites.c.invited_user_hash))
+    if invited_user_hash is None:
         raise HTTPException(400, "Invite not found.")
 
-    db.delete(db_invite)
-    db.commit()
-    team_invites = get_team_invites(db=db, team_hash=inviter_user.team_hash)
+    await db.commit()
+    _publish_invite("cancelled", team_hash=inviter_user.team_hash, invited_user_hash=invited_user_hash,
+                    invited_osu_id=invited_user_osu_id)
+    team_invites = await get_team_invites(db=db, team_hash=inviter_user.team_hash)
     return team_invites
 
 
-def ban_user(db: Session, user_osu_id: int):
-    user_to_be_banned = get_user_by_osu_id(db=db, osu_id=user_osu_id)
-    if user_to_be_banned.team_hash:
-        team = get_team(db=db, team_hash=user_to_be_banned.team_hash)
-        invites = get_team_invites(db=db, team_hash=user_to_be_banned.team_hash)
-        for invite in invites:
-            db.delete(invite)
-        db.delete(team)
-    user_to_be_banned.is_banned = True
-    db.commit()
+async def ban_user(db: AsyncSession, user_osu_id: int):
+    users, teams, invites = models.User.__table__, models.Team.__table__, models.Invite.__table__
+    user_to_be_banned = await db.scalar(select(models.User).from_statement(update(users).where(
+        users.c.osu_id == user_osu_id).values(is_banned=True).returning(*users.c)))
+    if user_to_be_banned is None:
+        raise HTTPException(400, "User has not signed-up yet.")
+
+    affected_user_hashes = [user_to_be_banned.user_hash]
+    team_hash = user_to_be_banned.team_hash
+    if team_hash:
+        # The team goes with its players and invites in one statement; the foreign keys are
+        # checked at its end, once all three are gone.
+        released = update(users).where(users.c.team_hash == team_hash).values(team_hash=None).returning(
+            users.c.user_hash).cte("released")
+        cleared = delete(invites).where(invites.c.team_hash == team_hash).cte("cleared")
+        released_user_hashes = await db.scalar(delete(teams).where(teams.c.team_hash == team_hash).returning(
+            select(func.array_agg(released.c.user_hash)).scalar_subquery()).add_cte(released).add_cte(cleared))
+        affected_user_hashes.extend(released_user_hashes or [])
+    await db.commit()
+
+    set_committed_value(user_to_be_banned, "team_hash", None)
+    set_committed_value(user_to_be_banned, "team", None)
+    invalidate_users(*affected_user_hashes)
+    versions.bump("roster")
     return user_to_be_banned
 
 
-def unban_user(db: Session, user_osu_id: int):
-    user_to_be_unbanned = get_user_by_osu_id(db=db, osu_id=user_osu_id)
+async def unban_user(db: AsyncSession, user_osu_id: int):
+    user_to_be_unbanned = await get_user_by_osu_id(db=db, osu_id=user_osu_id)
     user_to_be_unbanned.is_banned = False
-    db.commit()
+    await db.commit()
+    invalidate_users(user_to_be_unbanned.user_hash)
+    versions.bump("roster")
     return user_to_be_unbanned
 
 
-def create_lobby(db: Session, lobby_name: str, lobby_time: datetime.datetime,
-                 referee_osu_username: Optional[str] = None):
+async def create_lobby(db: AsyncSession, lobby_name: str, lobby_time: datetime.datetime,
+                       referee_osu_username: Optional[str] = None):
     db_lobby = models.QualifierLobby(lobby_name=lobby_name, date=lobby_time,
-                                     referee=referee_osu_username)
+                                     referee=referee_osu_username, teams=[])
     db.add(db_lobby)
-    db.commit()
-    db.refresh(db_lobby)
+    await db.commit()
+    versions.bump("lobbies")
 
     return db_lobby
 
 
-def add_referee_to_lobby(db: Session, lobby_id: int, referee_osu_username: str):
-    db_lobby = get_lobby(db=db, lobby_id=lobby_id)
+async def add_referee_to_lobby(db: AsyncSession, lobby_id: int, referee_osu_username: str):
+    db_lobby = await get_lobby(db=db, lobby_id=lobby_id)
     db_lobby.referee = referee_osu_username
-    db.commit()
-    db.refresh(db_lobby)
+    await db.commit()
+    versions.bump("lobbies")
 
     return db_lobby
 
 
-def remove_lobby(db: Session, lobby_id: int):
-    db_lobby = get_lobby(db=db, lobby_id=lobby_id)
+async def remove_lobby(db: AsyncSession, lobby_id: int):
+    db_lobby = await get_lobby(db=db, lobby_id=lobby_id)
     if db_lobby is None:
         raise HTTPException(401, "Selected lobby does not exist.")
 
-    db.delete(db_lobby)
-    db.commit()
+    await db.delete(db_lobby)
+    await db.commit()
+    # Deleting the lobby also detaches its teams.
+    versions.bump("lobbies", "roster")
     return
@@ -1,12 +1,67 @@
 import os
+import random
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+
+from utils.metrics import InstrumentedPool, instrument_engine
+from utils.replicas import track_writes
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
+# Comma-separated streaming replicas of DATABASE_URL that take the lag-tolerant reads.
+REPLICA_DATABASE_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# LISTEN needs a session-level connection of its own, so this may bypass a pooler in front of Postgres.
+LISTEN_DATABASE_DSN = make_url(os.getenv("DATABASE_LISTEN_URL", SQLALCHEMY_DATABASE_URL)).set(
+    drivername="postgresql").render_as_string(hide_password=False)
+
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+# DB_MAX_CONNECTIONS is the share of Postgres max_connections this deployment may use. It is split
+# evenly across the workers, less the one connection each keeps for the cache bus, with no overflow.
+if os.getenv("DB_MAX_CONNECTIONS"):
+    POOL_SIZE = max(1, int(os.getenv("DB_MAX_CONNECTIONS")) // WEB_CONCURRENCY - 1)
+    MAX_OVERFLOW = 0
+else:
+    POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+    MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
 
 engine = create_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+def _create_async_engine(url: str) -> AsyncEngine:
+    db_engine = create_async_engine(make_url(url).set(drivername="postgresql+asyncpg"),
+                                    poolclass=InstrumentedPool,
+                                    pool_size=POOL_SIZE,
+                                    max_overflow=MAX_OVERFLOW,
+                                    pool_timeout=POOL_TIMEOUT,
+                                    pool_recycle=POOL_RECYCLE,
+                                    pool_pre_ping=True)
+    instrument_engine(db_engine.sync_engine)
+    return db_engine
+
+
+class PrimarySession(Session):
+    # Commits through this class make the client read from the primary for a while.
+    pass
+
+
+track_writes(PrimarySession)
+
+async_engine = _create_async_engine(SQLALCHEMY_DATABASE_URL)
+AsyncSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False,
+                                 bind=async_engine, class_=AsyncSession, sync_session_class=PrimarySession)
+
+replica_engines = [_create_async_engine(url) for url in REPLICA_DATABASE_URLS]
+ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, class_=AsyncSession)
+
+
+def replica_session() -> AsyncSession:
+    return ReplicaSessionLocal(bind=random.choice(replica_engines))
+
+
 Base = declarative_base()
@@ -0,0 +1,100 @@
+from typing import Callable, List, NamedTuple, Union
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from .database import Base
+
+# Arbitrary key for pg_advisory_xact_lock so only one worker migrates at a time.
+MIGRATION_LOCK_ID = 7_220_221
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    # Either SQL statements or a callable run against the synchronous connection.
+    steps: Union[List[str], Callable]
+
+
+def _create_initial_schema(connection):
+    Base.metadata.create_all(bind=connection)
+
+
+# Append only. Steps must stay idempotent (IF NOT EXISTS) because version 1 builds fresh
+# databases from the current models, which already contain everything added later.
+MIGRATIONS = [
+    Migration(1, "initial schema", _create_initial_schema),
+    Migration(2, "indexes for crud query patterns", [
+        "CREATE INDEX IF NOT EXISTS ix_users_team_hash ON users (team_hash)",
+        "CREATE INDEX IF NOT EXISTS ix_users_osu_username_lower_osu_id ON users (lower(osu_username), osu_id)",
+        "CREATE INDEX IF NOT EXISTS ix_teams_lobby_id ON teams (lobby_id)",
+        "CREATE INDEX IF NOT EXISTS ix_invites_team_hash_invited_user_hash ON invites (team_hash, invited_user_hash)",
+        "CREATE INDEX IF NOT EXISTS ix_invites_invited_user_hash ON invites (invited_user_hash)",
+        "CREATE INDEX IF NOT EXISTS ix_mappools_type_id ON mappools (type, id)",
+        "CREATE INDEX IF NOT EXISTS ix_team_scores_map_id_score ON team_scores (map_id, score DESC)",
+        "CREATE INDEX IF NOT EXISTS ix_player_scores_map_id_score ON player_scores (map_id, score DESC)",
+    ]),
+    Migration(3, "column types matching the stored data", [
+        "ALTER TABLE team_scores ALTER COLUMN zscore TYPE DOUBLE PRECISION",
+        "ALTER TABLE mappools ALTER COLUMN length TYPE TIME USING length::time",
+        "ALTER TABLE team_scores DROP CONSTRAINT IF EXISTS team_scores_map_id_fkey",
+        "ALTER TABLE player_scores DROP CONSTRAINT IF EXISTS player_scores_map_id_fkey",
+    ]),
+    Migration(4, "avatar upload jobs", [
+        "CREATE TABLE IF NOT EXISTS avatar_jobs ("
+        "id VARCHAR PRIMARY KEY, "
+        "team_hash VARCHAR NOT NULL REFERENCES teams (team_hash) ON DELETE CASCADE, "
+        "status VARCHAR NOT NULL, "
+        "attempts INTEGER NOT NULL, "
+        "image BYTEA, "
+        "avatar_url VARCHAR, "
+        "error VARCHAR, "
+        "run_at TIMESTAMP NOT NULL DEFAULT now(), "
+        "created_at TIMESTAMP NOT NULL DEFAULT now())",
+        "CREATE INDEX IF NOT EXISTS ix_avatar_jobs_status_run_at ON avatar_jobs (status, run_at)",
+    ]),
+    Migration(5, "content-addressed avatar cache", [
+        "ALTER TABLE avatar_jobs ADD COLUMN IF NOT EXISTS source_hash VARCHAR",
+        "ALTER TABLE avatar_jobs ADD COLUMN IF NOT EXISTS pixel_hash VARCHAR",
+        "CREATE TABLE IF NOT EXISTS avatar_cache ("
+        "hash VARCHAR PRIMARY KEY, "
+        "avatar_url VARCHAR NOT NULL, "
+        "last_used_at TIMESTAMP NOT NULL DEFAULT now(), "
+        "created_at TIMESTAMP NOT NULL DEFAULT now())",
+        "CREATE INDEX IF NOT EXISTS ix_avatar_cache_last_used_at ON avatar_cache (last_used_at)",
+    ]),
+    Migration(6, "user keyset on osu_id", [
+        "DROP INDEX IF EXISTS ix_users_osu_username_lower",
+        "CREATE INDEX IF NOT EXISTS ix_users_osu_username_lower_osu_id ON users (lower(osu_username), osu_id)",
+    ]),
+    Migration(7, "shared etag versions", [
+        "CREATE TABLE IF NOT EXISTS resource_versions (name VARCHAR PRIMARY KEY, version BIGINT NOT NULL)",
+        "INSERT INTO resource_versions (name, version) VALUES ('epoch', floor(random() * 1e15)) "
+        "ON CONFLICT (name) DO NOTHING",
+    ]),
+]
+
+
+async def _apply(connection: AsyncConnection, migration: Migration):
+    if callable(migration.steps):
+        await connection.run_sync(migration.steps)
+    else:
+        for statement in migration.steps:
+            await connection.execute(text(statement))
+
+    await connection.execute(text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                             {"version": migration.version, "name": migration.name})
+
+
+async def migrate(engine: AsyncEngine):
+    async with engine.begin() as connection:
+        await connection.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": MIGRATION_LOCK_ID})
+        await connection.execute(text("CREATE TABLE IF NOT EXISTS schema_migrations ("
+                                      "version INTEGER PRIMARY KEY, "
+                                      "name VARCHAR NOT NULL, "
+                                      "applied_at TIMESTAMP NOT NULL DEFAULT now())"))
+        applied = set((await connection.execute(text("SELECT version FROM schema_migrations"))).scalars())
+
+        for migration in MIGRATIONS:
+            if migration.version not in applied:
+                await _apply(connection, migration)
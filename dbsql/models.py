@@ -1,4 +1,5 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Float
+from sqlalchemy import (BigInteger, Boolean, Column, ForeignKey, Integer, String, DateTime, Float, Index, LargeBinary, Time,
+                        func)
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -21,9 +22,13 @@ class User(Base):
     badges = Column(Integer)
     is_banned = Column(Boolean, default=False)
     is_admin = Column(Boolean, default=False)
-    team_hash = Column(String, ForeignKey("teams.team_hash"))
+    team_hash = Column(String, ForeignKey("teams.team_hash"), index=True)
+
+    team = relationship("Team", back_populates="players", lazy="raise_on_sql")
+
 
-    team = relationship("Team", back_populates="players")
+# Matches the keyset ordering of crud.get_users.
+Index("ix_users_osu_username_lower_osu_id", func.lower(User.osu_username), User.osu_id)
 
 
 class Team(Base):
@@ -32,23 +37,27 @@ class Team(Base):
     team_hash = Column(String, primary_key=True, index=True)
     title = Column(String, index=True, unique=True)
     avatar_url = Column(String)
-    lobby_id = Column(Integer, ForeignKey("lobbies.id"))
+    lobby_id = Column(Integer, ForeignKey("lobbies.id"), index=True)
     lobby = relationship("QualifierLobby", back_populates="teams")
 
-    players = relationship("User", back_populates="team")
+    players = relationship("User", back_populates="team", lazy="raise_on_sql")
 
 
 class Invite(Base):
     __tablename__ = "invites"
+    __table_args__ = (
+        Index("ix_invites_team_hash_invited_user_hash", "team_hash", "invited_user_hash"),
+        Index("ix_invites_invited_user_hash", "invited_user_hash"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     invited_user_hash = Column(String, ForeignKey("users.user_hash"))
     inviter_user_hash = Column(String, ForeignKey("users.user_hash"))
     team_hash = Column(String, ForeignKey("teams.team_hash"))
 
-    team = relationship("Team")
-    inviter = relationship("User", foreign_keys=[inviter_user_hash])
-    invited = relationship("User", foreign_keys=[invited_user_hash])
+    team = relationship("Team", lazy="raise_on_sql")
+    inviter = relationship("User", foreign_keys=[inviter_user_hash], lazy="raise_on_sql")
+    invited = relationship("User", foreign_keys=[invited_user_hash], lazy="raise_on_sql")
 
 
 class QualifierLobby(Base):
@@ -59,11 +68,14 @@ class QualifierLobby(Base):
     referee = Column(String, nullable=True)
 
     date = Column(DateTime)
-    teams = relationship("Team", back_populates="lobby")
+    teams = relationship("Team", back_populates="lobby", lazy="raise_on_sql")
 
 
 class Mappools(Base):
     __tablename__ = "mappools"
+    __table_args__ = (
+        Index("ix_mappools_type_id", "type", "id"),
+    )
 
     _id = Column(Integer, primary_key=True)
     id = Column("id", String, index=True)
@@ -72,7 +84,7 @@ class Mappools(Base):
     raw_title = Column("RAW artist - title [difficulty]", String)
     sr = Column("sr", Float)
     bpm = Column("bpm", Integer)
-    length = Column("length", DateTime(timezone=False))
+    length = Column("length", Time)
     cs = Column("cs", String)
     ar = Column("ar", String)
     od = Column("od", String)
@@ -91,11 +103,15 @@ class TeamScore(Base):
     teamname = Column(String, ForeignKey("teams.title"))
     team = relationship("Team")
 
-    map_id = Column(String, ForeignKey("mappools.id"))
-    map = relationship("Mappools")
+    # Map ids are only unique per mappool type, so they cannot carry a foreign key.
+    map_id = Column(String)
+    map = relationship("Mappools", primaryjoin="foreign(TeamScore.map_id) == Mappools.id", viewonly=True)
 
     score = Column(Integer, nullable=True)
-    zscore = Column(Integer, nullable=True)
+    zscore = Column(Float, nullable=True)
+
+
+Index("ix_team_scores_map_id_score", TeamScore.map_id, TeamScore.score.desc())
 
 
 class PlayerScore(Base):
@@ -106,7 +122,49 @@ class PlayerScore(Base):
     username = Column(String, ForeignKey("users.osu_username"))
     user = relationship("User")
 
-    map_id = Column(String, ForeignKey("mappools.id"))
-    map = relationship("Mappools")
+    # Map ids are only unique per mappool type, so they cannot carry a foreign key.
+    map_id = Column(String)
+    map = relationship("Mappools", primaryjoin="foreign(PlayerScore.map_id) == Mappools.id", viewonly=True)
 
     score = Column(Integer, nullable=True)
+
+
+Index("ix_player_scores_map_id_score", PlayerScore.map_id, PlayerScore.score.desc())
+
+
+class AvatarJob(Base):
+    __tablename__ = "avatar_jobs"
+    __table_args__ = (
+        Index("ix_avatar_jobs_status_run_at", "status", "run_at"),
+    )
+
+    id = Column(String, primary_key=True)
+    team_hash = Column(String, ForeignKey("teams.team_hash", ondelete="CASCADE"), nullable=False)
+    status = Column(String, nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    # The thumbnail waiting to be uploaded, cleared once the job finishes.
+    image = Column(LargeBinary, nullable=True)
+    source_hash = Column(String, nullable=True)
+    pixel_hash = Column(String, nullable=True)
+    avatar_url = Column(String, nullable=True)
+    error = Column(String, nullable=True)
+    run_at = Column(DateTime, nullable=False, server_default=func.now())
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
+class AvatarCache(Base):
+    __tablename__ = "avatar_cache"
+
+    # "file:" or "pixels:" followed by a sha256, see utils.image.
+    hash = Column(String, primary_key=True)
+    avatar_url = Column(String, nullable=False)
+    last_used_at = Column(DateTime, nullable=False, server_default=func.now(), index=True)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+
+
+class ResourceVersion(Base):
+    __tablename__ = "resource_versions"
+
+    # The ETag counters from dbsql.cache, plus an "epoch" row set once when the table is created.
+    name = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False)
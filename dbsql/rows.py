@@ -0,0 +1,48 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Sequence
+
+from . import models, schemas
+
+# Plain-dict builders for the large list endpoints. They take column tuples straight from the
+# driver and produce exactly the shape the response schemas would, without building ORM objects
+# or validating them again; the routes hand the result to ORJSONResponse.
+USER_FIELDS = tuple(schemas.TeamlessUser.__fields__)
+TEAM_FIELDS = tuple(schemas.PlayerlessTeam.__fields__)
+LOBBY_FIELDS = ("id", "lobby_name", "referee", "date")
+
+USER_COLUMNS = tuple(getattr(models.User, name) for name in USER_FIELDS)
+TEAM_COLUMNS = tuple(getattr(models.Team, name) for name in TEAM_FIELDS)
+LOBBY_COLUMNS = tuple(getattr(models.QualifierLobby, name) for name in LOBBY_FIELDS)
+
+
+def user_rows(rows: Iterable[Sequence]) -> List[dict]:
+    # Rows are USER_COLUMNS followed by the TEAM_COLUMNS of an outer-joined team; anything after
+    # those (such as the keyset columns) is left out of the output.
+    split = len(USER_FIELDS)
+    end = split + len(TEAM_FIELDS)
+    team_hash_at = split + TEAM_FIELDS.index("team_hash")
+    return [{**dict(zip(USER_FIELDS, row[:split])),
+             "team": dict(zip(TEAM_FIELDS, row[split:end])) if row[team_hash_at] is not None else None}
+            for row in rows]
+
+
+def players_by_team(rows: Iterable[Sequence]) -> Dict[str, List[dict]]:
+    # Rows are USER_COLUMNS followed by the player's team_hash.
+    players = defaultdict(list)
+    for row in rows:
+        players[row[-1]].append(dict(zip(USER_FIELDS, row[:-1])))
+    return players
+
+
+def team_rows(rows: Iterable[Sequence], players: Dict[str, List[dict]]) -> List[dict]:
+    team_hash_at = TEAM_FIELDS.index("team_hash")
+    return [{**dict(zip(TEAM_FIELDS, row)), "players": players.get(row[team_hash_at], [])} for row in rows]
+
+
+def lobby_rows(rows: Iterable[Sequence], teams: Iterable[Sequence],
+               players: Dict[str, List[dict]]) -> List[dict]:
+    # teams are TEAM_COLUMNS followed by the team's lobby_id.
+    teams_by_lobby = defaultdict(list)
+    for team in teams:
+        teams_by_lobby[team[-1]].extend(team_rows([team[:-1]], players))
+    return [{**dict(zip(LOBBY_FIELDS, row)), "teams": teams_by_lobby.get(row[0], [])} for row in rows]
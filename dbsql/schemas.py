@@ -1,7 +1,7 @@
 import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, PrivateAttr, validator
 
 
 class TeamBase(BaseModel):
@@ -117,6 +117,13 @@ class Mappool(BaseModel):
     map_id: int
     youtube: Optional[str]
 
+    # The columns behind cs, ar and od are text, so a sync stores what was sent instead of the float's repr.
+    _source_text: Dict[str, str] = PrivateAttr(default_factory=dict)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self._source_text = {key: str(value) for key, value in data.items() if isinstance(value, (str, int, float))}
+
     class Config:
         orm_mode = True
 
@@ -144,3 +151,28 @@ class TeamMapScore(OverallTeamScore):
 
 class PlayerMapScore(OverallPlayerScore):
     map_id: str
+
+
+class ScoreUpload(BaseModel):
+    rows: int
+
+
+class AvatarJob(BaseModel):
+    id: str
+    status: str
+    attempts: int
+    avatar_url: Optional[str]
+    error: Optional[str]
+
+    class Config:
+        orm_mode = True
+
+
+class ProfileRefresh(BaseModel):
+    users: int
+    fetched: int
+    missing: int
+    failed: int
+    updated: int
+    seconds: float
+    profiles_per_second: float
@@ -0,0 +1,65 @@
+import asyncio
+import sys
+import time
+from typing import List
+
+from sqlalchemy import select, text
+
+from dbsql import models
+from dbsql.database import POOL_SIZE, AsyncSessionLocal, SessionLocal, async_engine, engine
+
+# Compares concurrent throughput of the old synchronous session, called straight from async routes,
+# with the AsyncSession the routes use now. Each simulated request waits LATENCY seconds in Postgres,
+# standing in for a slow round trip, then looks a user up by user_hash. Read-only, so any database
+# with the schema will do. Usage: python -m extras.bench_concurrency [requests] [concurrency]
+REQUESTS = 200
+CONCURRENCY = 50
+LATENCY = 0.01
+
+LOOKUP = select(models.User).where(models.User.user_hash == "bench")
+
+
+async def sync_request():
+    # What the routes did before: every round trip blocks the event loop until it returns.
+    with SessionLocal() as db:
+        db.execute(text("SELECT pg_sleep(:latency)"), {"latency": LATENCY})
+        db.scalar(LOOKUP)
+
+
+async def async_request():
+    async with AsyncSessionLocal() as db:
+        await db.execute(text("SELECT pg_sleep(:latency)"), {"latency": LATENCY})
+        await db.scalar(LOOKUP)
+
+
+async def run(request, requests: int, concurrency: int) -> List[float]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await request()
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return latencies
+
+
+async def main(requests: int, concurrency: int):
+    print(f"{requests} requests, {concurrency} concurrent, {LATENCY * 1000:.0f} ms per round trip, "
+          f"pool size {POOL_SIZE}")
+    for name, request in (("sync session", sync_request), ("AsyncSession", async_request)):
+        await run(request, concurrency, concurrency)
+        start = time.perf_counter()
+        latencies = sorted(await run(request, requests, concurrency))
+        elapsed = time.perf_counter() - start
+        print(f"{name:14} {requests / elapsed:8.1f} req/s   p50 {latencies[len(latencies) // 2] * 1000:7.1f} ms   "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:7.1f} ms")
+    await async_engine.dispose()
+    engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else REQUESTS,
+                     int(sys.argv[2]) if len(sys.argv) > 2 else CONCURRENCY))
@@ -0,0 +1,73 @@
+import asyncio
+import json
+import sys
+import time
+from typing import List, Tuple
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from dbsql import models, schemas
+from dbsql.rows import TEAM_FIELDS, USER_FIELDS, players_by_team, team_rows, user_rows
+
+# Compares the default response path (orm_mode validation + jsonable_encoder + json) with the
+# column-tuple path used by /users and /teams, on in-memory data so no database is needed.
+# Usage: python -m extras.bench_serialization [repeats]
+USERS = 5000
+TEAMS = 500
+REPEATS = 20
+
+
+def make_data():
+    team_tuples = [(f"Team {i}", f"team{i}", f"https://i.imgur.com/{i}.png") for i in range(TEAMS)]
+    user_tuples = []
+    for i in range(USERS):
+        team = team_tuples[i // 2] if i < TEAMS * 2 else (None, None, None)
+        user = (str(10 ** 17 + i), f"https://cdn.discordapp.com/avatars/{i}.png", f"player{i}#0001", i,
+                f"Player{i}", f"https://a.ppy.sh/{i}", i * 7, i * 5, i % 4, False, False)
+        user_tuples.append((*user, *team))
+
+    db_teams = {team[1]: models.Team(**dict(zip(TEAM_FIELDS, team))) for team in team_tuples}
+    db_users = []
+    for row in user_tuples:
+        db_user = models.User(**dict(zip(USER_FIELDS, row)))
+        db_user.team = db_teams.get(row[len(USER_FIELDS) + 1])
+        db_users.append(db_user)
+    return user_tuples, team_tuples, db_users, list(db_teams.values())
+
+
+def timed(run, repeats: int) -> Tuple[float, bytes]:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        body = run()
+    return (time.perf_counter() - start) / repeats * 1000, body
+
+
+def main(repeats: int):
+    user_tuples, team_tuples, db_users, db_teams = make_data()
+    loop = asyncio.new_event_loop()
+
+    def default_path(response_type, content):
+        field = create_response_field(name="response", type_=response_type)
+        return lambda: JSONResponse(loop.run_until_complete(
+            serialize_response(field=field, response_content=content))).body
+
+    player_tuples = [(*row[:len(USER_FIELDS)], row[len(USER_FIELDS) + 1]) for row in user_tuples[:TEAMS * 2]]
+    cases = {
+        f"{USERS} users": (default_path(List[schemas.User], db_users),
+                           lambda: ORJSONResponse(user_rows(user_tuples)).body),
+        f"{TEAMS} teams": (default_path(List[schemas.Team], db_teams),
+                           lambda: ORJSONResponse(team_rows(team_tuples, players_by_team(player_tuples))).body),
+    }
+    for name, (default, fast) in cases.items():
+        default_ms, default_body = timed(default, repeats)
+        fast_ms, fast_body = timed(fast, repeats)
+        if json.loads(default_body) != json.loads(fast_body):
+            raise SystemExit(f"{name}: the two paths produced different bodies")
+        print(f"{name:12} default {default_ms:8.2f} ms   rows+orjson {fast_ms:8.2f} ms   "
+              f"{default_ms / fast_ms:5.1f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else REPEATS)
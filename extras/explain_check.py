@@ -0,0 +1,127 @@
+import asyncio
+import json
+import sys
+
+from sqlalchemy import event, text
+
+from dbsql import crud, migrations
+from dbsql.database import AsyncSessionLocal, async_engine
+
+# Seeds DATABASE_URL with a large synthetic dataset, runs the crud read paths against it and
+# fails if any statement they issue plans a sequential scan. The tables are TRUNCATED first,
+# so only point this at a throwaway database: python -m extras.explain_check --seed
+USERS = 50000
+LOBBIES = 2000
+MAPPOOL_TYPES = 50
+MAPS_PER_POOL = 10
+SCORING_TEAMS = 1000
+SCORING_PLAYERS = 2000
+
+SEED_STATEMENTS = [
+    "TRUNCATE avatar_jobs, team_scores, player_scores, invites, users, teams, lobbies, mappools",
+    f"INSERT INTO lobbies (id, lobby_name, date) "
+    f"SELECT i, 'Lobby ' || i, now() + i * interval '30 minutes' FROM generate_series(1, {LOBBIES}) i",
+    f"INSERT INTO teams (team_hash, title, lobby_id) "
+    f"SELECT 'team' || i, 'Team ' || i, CASE WHEN i % 4 = 0 THEN i % {LOBBIES} + 1 END "
+    f"FROM generate_series(1, {USERS * 2 // 5}) i",
+    f"INSERT INTO users (user_hash, osu_id, osu_username, osu_avatar_url, osu_linked, discord_linked, "
+    f"is_banned, is_admin, badges, bws_rank, team_hash) "
+    f"SELECT 'user' || i, i, 'Player' || i, '', true, i % 2 = 0, i % 100 = 0, false, 0, i, "
+    f"CASE WHEN i <= {USERS * 4 // 5} THEN 'team' || ((i + 1) / 2) END FROM generate_series(1, {USERS}) i",
+    f"INSERT INTO invites (id, invited_user_hash, inviter_user_hash, team_hash) "
+    f"SELECT i, 'user' || ({USERS} - i % 5000), 'user' || (2 * i - 1), 'team' || i "
+    f"FROM generate_series(1, {USERS // 5}) i",
+    f"INSERT INTO mappools (_id, id, type, mods, \"artist - title [difficulty]\", "
+    f"\"RAW artist - title [difficulty]\", sr, bpm, length, cs, ar, od, mapset, \"set id\", \"map id\") "
+    f"SELECT i, 'M' || i, 'pool' || (i / {MAPS_PER_POOL}), 'NM', 'Song', 'Song', 5.5, 180, '00:03:00', "
+    f"'4', '9', '8', 'Set', i, i FROM generate_series(0, {MAPPOOL_TYPES * MAPS_PER_POOL - 1}) i",
+    f"INSERT INTO team_scores (\"index\", teamname, map_id, score, zscore) "
+    f"SELECT row_number() OVER () - 1, 'Team ' || t, 'M' || m, (random() * 1000000)::int, random() "
+    f"FROM generate_series(1, {SCORING_TEAMS}) t, generate_series(0, {MAPPOOL_TYPES * MAPS_PER_POOL - 1}) m",
+    f"INSERT INTO player_scores (\"index\", username, map_id, score) "
+    f"SELECT row_number() OVER () - 1, 'Player' || p, 'M' || m, (random() * 1000000)::int "
+    f"FROM generate_series(1, {SCORING_PLAYERS}) p, generate_series(0, {MAPPOOL_TYPES * MAPS_PER_POOL - 1}) m",
+    "ANALYZE",
+]
+
+# crud.get_lobbies and get_lobby_rows are left out on purpose: they return every lobby, so a full scan
+# is the right plan.
+CHECKS = {
+    "get_user": lambda db: crud.get_user(db=db, user_hash="user1234"),
+    "get_user_by_osu_id": lambda db: crud.get_user_by_osu_id(db=db, osu_id=1234),
+    "get_user_by_osu_username": lambda db: crud.get_user_by_osu_username(db=db, osu_username="Player1234"),
+    "get_users": lambda db: crud.get_users(db=db, after=["Player1234", 1234]),
+    "get_users(has_team, in_lobby)": lambda db: crud.get_users(db=db, has_team=True, in_lobby=True),
+    "get_user_rows": lambda db: crud.get_user_rows(db=db, after=["Player1234", 1234]),
+    "get_user_invites": lambda db: crud.get_user_invites(db=db, user_hash=f"user{USERS}"),
+    "get_team_invites": lambda db: crud.get_team_invites(db=db, team_hash="team1234"),
+    "get_invite": lambda db: crud.get_invite(db=db, team_hash="team1234", user_hash="user1234"),
+    "get_teams": lambda db: crud.get_teams(db=db, after="Team 1234"),
+    "get_team_rows": lambda db: crud.get_team_rows(db=db, after="Team 1234"),
+    "get_team": lambda db: crud.get_team(db=db, team_hash="team1234"),
+    "get_lobby": lambda db: crud.get_lobby(db=db, lobby_id=12),
+    "get_lobby_player_count": lambda db: crud.get_lobby_player_count(db=db, lobby_id=12),
+    "get_mappool": lambda db: crud.get_mappool(db=db, mappool_type="pool3"),
+    "get_team_scores": lambda db: crud.get_team_scores(db=db, map_id="M12"),
+    "get_player_scores": lambda db: crud.get_player_scores(db=db, map_id="M12"),
+    "get_team_scores_overall": lambda db: crud.get_team_scores_overall(db=db, mappool_type="pool4"),
+    "get_player_scores_overall": lambda db: crud.get_player_scores_overall(db=db, mappool_type="pool5"),
+}
+
+
+def find_seq_scans(plan: dict) -> list:
+    scans = [plan["Relation Name"]] if plan["Node Type"] == "Seq Scan" else []
+    for child in plan.get("Plans", []):
+        scans.extend(find_seq_scans(child))
+    return scans
+
+
+async def seed():
+    async with async_engine.begin() as connection:
+        for statement in SEED_STATEMENTS:
+            await connection.execute(text(statement))
+
+
+async def check() -> list:
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+
+    failures = []
+    for name, run in CHECKS.items():
+        captured.clear()
+        event.listen(async_engine.sync_engine, "before_cursor_execute", capture)
+        try:
+            async with AsyncSessionLocal() as db:
+                await run(db)
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", capture)
+
+        async with async_engine.connect() as connection:
+            for statement, parameters in list(captured):
+                result = await connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+                plan = result.scalar()
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                scans = find_seq_scans(plan[0]["Plan"])
+                status = f"SEQ SCAN on {', '.join(scans)}" if scans else "ok"
+                print(f"{name:32} {status:40} {' '.join(statement.split())[:100]}")
+                if scans:
+                    failures.append(name)
+    return failures
+
+
+async def main():
+    if "--seed" not in sys.argv:
+        sys.exit("This truncates every table in DATABASE_URL. Re-run with --seed against a throwaway database.")
+
+    await migrations.migrate(async_engine)
+    await seed()
+    failures = await check()
+    await async_engine.dispose()
+    if failures:
+        sys.exit(f"Sequential scans planned by: {', '.join(sorted(set(failures)))}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
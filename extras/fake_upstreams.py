@@ -0,0 +1,96 @@
+import argparse
+import asyncio
+import hashlib
+import random
+
+from aiohttp import web
+
+# Local stand-ins for the third-party APIs, for exercising the app without real credentials. Point the app
+# at it with OSU_BASE_URL, DISCORD_BASE_URL and IMGUR_BASE_URL set to http://localhost:9000 and run:
+# python -m extras.fake_upstreams --port 9000 [--fail-rate 0.3] [--latency 0.05]
+# --fail-rate makes that share of requests answer 503 so retry paths get exercised, --latency adds
+# that many seconds to every response. The OAuth code passed to /osu-identify or /discord-identify
+# becomes the signed-in account id, so a numeric code picks which user logs in.
+
+
+@web.middleware
+async def simulate_upstream(request: web.Request, handler):
+    await asyncio.sleep(request.app["latency"])
+    if random.random() < request.app["fail_rate"]:
+        return web.json_response({"status": 503, "success": False, "error": "Over capacity"}, status=503)
+    return await handler(request)
+
+
+async def oauth_token(request: web.Request) -> web.Response:
+    form = await request.post()
+    subject = form.get("code") or f"{random.getrandbits(64):x}"
+    return web.json_response({"token_type": "Bearer", "expires_in": 86400,
+                              "access_token": f"fake-{form.get('grant_type')}-{subject}"})
+
+
+def token_subject(request: web.Request) -> int:
+    subject = request.headers.get("Authorization", "").rsplit("-", 1)[-1]
+    return int(subject) if subject.isdigit() else int(hashlib.sha1(subject.encode()).hexdigest()[:8], 16)
+
+
+def osu_profile(osu_id: int) -> dict:
+    # Deterministic per id; some badges carry filtered words so the badge filter has work to do.
+    badges = [{"description": f"Winning Team {n}" if n % 2 else f"Mapping contest {n}", "awarded_at": None}
+              for n in range(osu_id % 5)]
+    return {"id": osu_id, "username": f"Player{osu_id}", "avatar_url": f"https://a.ppy.sh/{osu_id}",
+            "statistics": {"global_rank": osu_id * 7919 % 100000 + 1}, "badges": badges}
+
+
+async def osu_user(request: web.Request) -> web.Response:
+    osu_id = int(request.match_info["osu_id"])
+    # Every 97th account behaves like a restricted one.
+    if osu_id % 97 == 0:
+        return web.json_response({"error": None}, status=404)
+    return web.json_response(osu_profile(osu_id))
+
+
+async def osu_me(request: web.Request) -> web.Response:
+    return web.json_response(osu_profile(token_subject(request)))
+
+
+async def discord_me(request: web.Request) -> web.Response:
+    discord_id = token_subject(request)
+    return web.json_response({"id": str(discord_id), "username": f"Player{discord_id}", "discriminator": "0001",
+                              "avatar": hashlib.md5(str(discord_id).encode()).hexdigest()})
+
+
+async def imgur_upload(request: web.Request) -> web.Response:
+    form = await request.post()
+    image = form.get("image")
+    if image is None:
+        return web.json_response({"status": 400, "success": False, "data": {"error": "No image"}}, status=400)
+
+    image = image.file.read() if isinstance(image, web.FileField) else image.encode()
+    image_id = hashlib.sha1(image).hexdigest()[:7]
+    request.app["uploads"][image_id] = image
+    return web.json_response({"status": 200, "success": True,
+                              "data": {"id": image_id, "link": f"https://i.imgur.com/{image_id}.png",
+                                       "size": len(image)}})
+
+
+def make_app(fail_rate: float = 0.0, latency: float = 0.0) -> web.Application:
+    app = web.Application(client_max_size=20 * 1024 ** 2, middlewares=[simulate_upstream])
+    app["fail_rate"] = fail_rate
+    app["latency"] = latency
+    app["uploads"] = {}
+    app.router.add_post("/oauth/token", oauth_token)
+    app.router.add_get("/api/v2/me/osu", osu_me)
+    app.router.add_get("/api/v2/users/{osu_id:-?[0-9]+}/osu", osu_user)
+    app.router.add_post("/api/oauth2/token", oauth_token)
+    app.router.add_get("/api/v10/users/@me", discord_me)
+    app.router.add_post("/3/upload", imgur_upload)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(make_app(fail_rate=args.fail_rate, latency=args.latency), port=args.port)
@@ -1,12 +1,10 @@
-import os
+import asyncio
 from itertools import cycle, islice
 
 import pandas as pd
-from sqlalchemy import create_engine
 
-SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
-
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+from dbsql import crud, models, schemas
+from dbsql.database import AsyncSessionLocal
 
 
 def add_mappool():
@@ -21,8 +19,16 @@ def add_mappool():
                            "https://www.youtube.com/watch?v=VI6w78iPkIk",
                            "https://www.youtube.com/watch?v=LWvwMJ1mwls",
                            "https://www.youtube.com/watch?v=7QDu4UMTH7w"]
-    mappools["type"] = "qf"
-    mappools.to_sql("mappools", con=engine, index=True, index_label="_id", if_exists="replace")
+    attribute_names = {column.key: attribute for attribute, column in models.Mappools.__mapper__.columns.items()}
+    mappools = mappools.rename(columns=attribute_names).astype(object)
+    mappools = mappools.where(mappools.notna(), None)
+    maps = [schemas.Mappool(**row) for row in mappools.to_dict(orient="records")]
+    asyncio.run(sync_mappool(mappool_type="qf", maps=maps))
+
+
+async def sync_mappool(mappool_type, maps):
+    async with AsyncSessionLocal() as db:
+        await crud.sync_mappool(db=db, mappool_type=mappool_type, maps=maps)
 
 
 def add_results():
@@ -33,18 +39,15 @@ def add_results():
         player_results = pd.read_excel(results_file, sheet_name="indiv results", header=None,
                                        names=["username"] + map_columns)
         player_results = refactor_df(player_results)
-        player_results.to_sql("player_scores", con=engine, index=True, if_exists="replace")
+        asyncio.run(replace_scores("player_scores", player_results[["username", "map_id", "score"]]))
 
     def add_team_results():
         team_results = pd.read_excel(results_file, sheet_name="results", header=None,
                                      names=["teamname"] + map_columns)
         team_results.drop([33, 34, 35], inplace=True)
         team_results = refactor_df(team_results)
-        zscores = pd.read_excel(results_file, sheet_name="zscore", header=None, names=["teamname"] + map_columns)
-        zscores = refactor_df(zscores)
-        team_results["zscore"] = zscores["score"]
-
-        team_results.to_sql("team_scores", con=engine, index=True, if_exists="replace")
+        # replace_scores recomputes the z-scores once the new rows are in.
+        asyncio.run(replace_scores("team_scores", team_results[["teamname", "map_id", "score"]]))
 
     def refactor_df(team_results):
         team_results["score"] = team_results[map_columns].values.tolist()
@@ -58,5 +61,15 @@ def add_results():
     add_team_results()
 
 
+async def replace_scores(table, results):
+    async def records():
+        # The spreadsheet row stands in for the line number crud.replace_scores reports problems by.
+        for line, (*keys, score) in enumerate(results.itertuples(index=False), start=1):
+            yield line, *(str(key) for key in keys), None if pd.isna(score) else int(score)
+
+    async with AsyncSessionLocal() as db:
+        await crud.replace_scores(db=db, table=table, columns=list(results.columns), records=records())
+
+
 if __name__ == '__main__':
     add_results()
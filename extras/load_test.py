@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import zlib
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+from sqlalchemy import text
+
+from dbsql import migrations
+from dbsql.database import async_engine
+from extras.fake_upstreams import make_app
+
+# Replays the tournament's traffic mix against the app running on DATABASE_URL with every upstream
+# faked locally, and reports latency and throughput per route. The tables are TRUNCATED and reseeded
+# first, so only point this at a throwaway database:
+# python -m extras.load_test --seed [--workers 4] [--output run.json] [--baseline previous.json]
+# The mix, all running at once:
+# - sign-up rush: new players go through /osu-identify and /discord-identify and are invited by
+#   captains of one-player teams through /team/invite,
+# - lobby burst: every complete team's captain joins a random qualifier lobby through /user/lobby/join,
+# - viewers: poll /mappool/team_scores with If-None-Match until the other two are done.
+USERS = 4000
+COMPLETE_TEAMS = 400
+SOLO_TEAMS = 200
+LOBBIES = 60
+MAPPOOL_TYPES = ("qf", "sf", "f", "gf")
+MAPS_PER_POOL = 10
+
+TEAMED_USERS = COMPLETE_TEAMS * 2 + SOLO_TEAMS
+SEED_STATEMENTS = [
+    "TRUNCATE avatar_jobs, avatar_cache, team_scores, player_scores, invites, users, teams, lobbies, mappools",
+    f"INSERT INTO lobbies (id, lobby_name, date) "
+    f"SELECT i, 'Lobby ' || i, now() + interval '2 days' + i * interval '1 hour' FROM generate_series(1, {LOBBIES}) i",
+    f"INSERT INTO teams (team_hash, title) "
+    f"SELECT 'team' || i, 'Team ' || i FROM generate_series(1, {COMPLETE_TEAMS + SOLO_TEAMS}) i",
+    f"INSERT INTO users (user_hash, osu_id, osu_username, osu_avatar_url, osu_global_rank, osu_linked, "
+    f"discord_id, discord_tag, discord_linked, is_banned, is_admin, badges, bws_rank, team_hash) "
+    f"SELECT 'user' || i, i, 'Player' || i, 'https://a.ppy.sh/' || i, i * 7, true, i::text, "
+    f"'Player' || i || '#0001', true, false, false, i % 3, i * 5, CASE "
+    f"WHEN i <= {COMPLETE_TEAMS * 2} THEN 'team' || ((i + 1) / 2) "
+    f"WHEN i <= {TEAMED_USERS} THEN 'team' || (i - {COMPLETE_TEAMS}) END "
+    f"FROM generate_series(1, {USERS}) i",
+    f"INSERT INTO mappools (_id, id, type, mods, \"artist - title [difficulty]\", "
+    f"\"RAW artist - title [difficulty]\", sr, bpm, length, cs, ar, od, mapset, \"set id\", \"map id\") "
+    f"SELECT row_number() OVER (), upper(p) || m, p, (ARRAY['NM', 'HD', 'HR', 'DT', 'FM'])[m % 5 + 1], "
+    f"'Artist - Song ' || m || ' [Insane]', 'Artist - Song ' || m || ' [Insane]', 5 + m / 10.0, 180, "
+    f"'00:03:00', '4', '9', '8', 'Mapper', m, m "
+    f"FROM unnest(ARRAY{list(MAPPOOL_TYPES)}) p, generate_series(1, {MAPS_PER_POOL}) m",
+    f"INSERT INTO team_scores (\"index\", teamname, map_id, score, zscore) "
+    f"SELECT row_number() OVER () - 1, teamname, map_id, score, "
+    f"(score - avg(score) OVER per_map) / stddev(score) OVER per_map FROM ("
+    f"SELECT 'Team ' || t AS teamname, upper(p) || m AS map_id, (random() * 1000000)::int AS score "
+    f"FROM generate_series(1, {COMPLETE_TEAMS}) t, unnest(ARRAY{list(MAPPOOL_TYPES)}) p, "
+    f"generate_series(1, {MAPS_PER_POOL}) m) s WINDOW per_map AS (PARTITION BY map_id)",
+    f"INSERT INTO player_scores (\"index\", username, map_id, score) "
+    f"SELECT row_number() OVER () - 1, 'Player' || u, upper(p) || m, (random() * 1000000)::int "
+    f"FROM generate_series(1, {COMPLETE_TEAMS * 2}) u, unnest(ARRAY{list(MAPPOOL_TYPES)}) p, "
+    f"generate_series(1, {MAPS_PER_POOL}) m",
+    "ANALYZE",
+]
+
+STARTUP_TIMEOUT = 60
+
+
+class Recorder:
+    def __init__(self):
+        self.samples: Dict[str, List[Tuple[float, int]]] = defaultdict(list)
+
+    async def request(self, sess: aiohttp.ClientSession, method: str, url: str, route: str,
+                      **kwargs) -> Tuple[int, aiohttp.ClientResponse]:
+        started = time.perf_counter()
+        try:
+            async with sess.request(method, url, allow_redirects=False, **kwargs) as resp:
+                await resp.read()
+                status = resp.status
+        except aiohttp.ClientError:
+            resp, status = None, 0
+        self.samples[f"{method} {route}"].append((time.perf_counter() - started, status))
+        return status, resp
+
+    def report(self, seconds: float) -> dict:
+        report = {}
+        for route, samples in sorted(self.samples.items()):
+            latencies = np.array([latency for latency, _ in samples]) * 1000
+            statuses = defaultdict(int)
+            for _, status in samples:
+                statuses[str(status)] += 1
+            report[route] = {"requests": len(samples), "rps": round(len(samples) / seconds, 1),
+                             "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+                             "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+                             "statuses": dict(sorted(statuses.items()))}
+        return report
+
+
+async def seed():
+    await migrations.migrate(async_engine)
+    async with async_engine.begin() as connection:
+        for statement in SEED_STATEMENTS:
+            await connection.execute(text(statement))
+    await async_engine.dispose()
+
+
+async def start_fakes(port: int, latency: float) -> web.AppRunner:
+    runner = web.AppRunner(make_app(latency=latency))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def start_app(port: int, fakes_url: str, workers: int) -> subprocess.Popen:
+    base_url = f"http://127.0.0.1:{port}"
+    env = {**os.environ, "DEV": "", "PORT": str(port), "WEB_CONCURRENCY": str(workers),
+           "OSU_BASE_URL": fakes_url, "DISCORD_BASE_URL": fakes_url, "IMGUR_BASE_URL": fakes_url,
+           "OSU_CLIENT_ID": "load-test", "OSU_CLIENT_SECRET": "load-test",
+           "DISCORD_CLIENT_ID": "load-test", "DISCORD_CLIENT_SECRET": "load-test", "IMGUR_CLIENT_ID": "load-test",
+           "REDIRECT_URI": base_url, "FRONTEND_HOMEPAGE": f"{base_url}/", "SIGN_UPS_CLOSE": "9999-12-31T00:00:00"}
+    env.setdefault("SECRET", "load-test")
+    return subprocess.Popen([sys.executable, "main.py"], env=env)
+
+
+async def wait_until_ready(sess: aiohttp.ClientSession, base_url: str, server: Optional[subprocess.Popen]):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            sys.exit("The app exited during startup.")
+        try:
+            async with sess.get(f"{base_url}/lobbies") as resp:
+                if resp.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    sys.exit(f"The app did not answer within {STARTUP_TIMEOUT} seconds.")
+
+
+def client_address(client: str) -> str:
+    # Clients a worker has not seen sign in yet are rate limited by address, so each simulated
+    # player and captain sends its own through X-Forwarded-For.
+    digest = zlib.crc32(client.encode())
+    return f"10.{digest >> 16 & 255}.{digest >> 8 & 255}.{digest & 255}"
+
+
+async def sign_up(recorder: Recorder, sess: aiohttp.ClientSession, base_url: str, osu_id: int, captain: str,
+                  limit: asyncio.Semaphore):
+    async with limit:
+        headers = {"X-Forwarded-For": client_address(str(osu_id))}
+        status, resp = await recorder.request(sess, "GET", f"{base_url}/osu-identify", "/osu-identify",
+                                              params={"code": str(osu_id)}, headers=headers)
+        if resp is None or "user_hash" not in resp.cookies:
+            return
+        user_hash = resp.cookies["user_hash"].value
+        await recorder.request(sess, "GET", f"{base_url}/discord-identify", "/discord-identify",
+                               params={"code": str(osu_id)}, cookies={"user_hash": user_hash}, headers=headers)
+        await recorder.request(sess, "POST", f"{base_url}/team/invite", "/team/invite",
+                               params={"other_user_osu_id": osu_id}, cookies={"user_hash": captain},
+                               headers={"X-Forwarded-For": client_address(captain)})
+
+
+async def join_lobby(recorder: Recorder, sess: aiohttp.ClientSession, base_url: str, captain: str, lobby_id: int,
+                     limit: asyncio.Semaphore):
+    async with limit:
+        await recorder.request(sess, "POST", f"{base_url}/user/lobby/join", "/user/lobby/join",
+                               params={"lobby_id": lobby_id}, cookies={"user_hash": captain},
+                               headers={"X-Forwarded-For": client_address(captain)})
+
+
+async def watch_standings(recorder: Recorder, sess: aiohttp.ClientSession, base_url: str, mappool_type: str,
+                          interval: float, done: asyncio.Event):
+    # Spread out like real viewers instead of polling in lockstep.
+    await asyncio.sleep(random.uniform(0, interval))
+    etag = None
+    while not done.is_set():
+        headers = {"If-None-Match": etag} if etag else {}
+        status, resp = await recorder.request(sess, "GET", f"{base_url}/mappool/team_scores",
+                                              "/mappool/team_scores", params={"mappool_type": mappool_type},
+                                              headers=headers)
+        if status == 200:
+            etag = resp.headers.get("ETag")
+        await asyncio.sleep(interval)
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.random_seed)
+    recorder = Recorder()
+    limit = asyncio.Semaphore(args.concurrency)
+    done = asyncio.Event()
+
+    fakes = await start_fakes(args.fakes_port, args.upstream_latency)
+    server = None if args.url else start_app(args.port, f"http://127.0.0.1:{args.fakes_port}", args.workers)
+    base_url = args.url or f"http://127.0.0.1:{args.port}"
+    try:
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar()) as sess:
+            await wait_until_ready(sess, base_url, server)
+
+            solo_captains = [f"user{COMPLETE_TEAMS * 2 + i}" for i in range(1, SOLO_TEAMS + 1)]
+            sign_ups = [sign_up(recorder, sess, base_url, USERS + i, solo_captains[i % SOLO_TEAMS], limit)
+                        for i in range(1, args.signups + 1)]
+            joins = [join_lobby(recorder, sess, base_url, f"user{2 * team - 1}", rng.randint(1, LOBBIES), limit)
+                     for team in range(1, COMPLETE_TEAMS + 1)]
+            viewers = [asyncio.create_task(watch_standings(recorder, sess, base_url, rng.choice(MAPPOOL_TYPES),
+                                                           args.poll_interval, done))
+                       for _ in range(args.viewers)]
+
+            started = time.perf_counter()
+            await asyncio.gather(*sign_ups, *joins)
+            done.set()
+            await asyncio.gather(*viewers)
+            seconds = time.perf_counter() - started
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        await fakes.cleanup()
+
+    print(f"Ran for {seconds:.1f}s")
+    return recorder.report(seconds)
+
+
+def print_report(report: dict, baseline: Optional[dict]):
+    print(f"{'route':32} {'requests':>9} {'req/s':>8} {'p50 ms':>9} {'p99 ms':>9}  statuses")
+    for route, stats in report.items():
+        line = (f"{route:32} {stats['requests']:9} {stats['rps']:8} {stats['p50_ms']:9} {stats['p99_ms']:9}  "
+                f"{' '.join(f'{status}:{count}' for status, count in stats['statuses'].items())}")
+        previous = (baseline or {}).get(route)
+        if previous:
+            line += "  vs baseline: " + " ".join(
+                f"{key} {(stats[key] - previous[key]) / previous[key]:+.0%}"
+                for key in ("rps", "p50_ms", "p99_ms") if previous[key])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", action="store_true", help="Truncate and reseed DATABASE_URL first.")
+    parser.add_argument("--url", help="Load an already running app instead of starting one.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--fakes-port", type=int, default=9000)
+    parser.add_argument("--upstream-latency", type=float, default=0.05)
+    parser.add_argument("--signups", type=int, default=400)
+    parser.add_argument("--viewers", type=int, default=200)
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--random-seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the per-route results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare against the JSON written by an earlier run.")
+    args = parser.parse_args()
+
+    if not args.seed:
+        sys.exit("This truncates every table in DATABASE_URL. Re-run with --seed against a throwaway database.")
+
+    asyncio.run(seed())
+    report = asyncio.run(run(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import asyncio
+import datetime
+import sys
+
+import aiohttp
+from sqlalchemy import text
+
+from dbsql.crud import LOBBY_CAPACITY
+from dbsql.database import async_engine
+
+# Fires concurrent /user/lobby/join calls from many complete teams at a single lobby on a running
+# server and checks that the lobby never ends up above capacity. Test rows are prefixed with
+# "stress-" and removed afterwards. Usage: python -m extras.lobby_stress http://localhost:8000 [teams]
+PREFIX = "stress-"
+
+
+async def seed(team_count: int) -> int:
+    lobby_date = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+    async with async_engine.begin() as connection:
+        lobby_id = (await connection.execute(text(
+            "INSERT INTO lobbies (lobby_name, date) VALUES (:name, :date) RETURNING id"),
+            {"name": f"{PREFIX}lobby", "date": lobby_date})).scalar_one()
+        await connection.execute(text(
+            "INSERT INTO teams (team_hash, title) "
+            "SELECT :prefix || 'team' || i, :prefix || i FROM generate_series(1, :teams) i"),
+            {"prefix": PREFIX, "teams": team_count})
+        await connection.execute(text(
+            "INSERT INTO users (user_hash, osu_id, osu_username, osu_linked, is_banned, is_admin, team_hash) "
+            "SELECT :prefix || 'user' || i, -i, :prefix || 'player' || i, true, false, false, "
+            ":prefix || 'team' || ((i + 1) / 2) FROM generate_series(1, :users) i"),
+            {"prefix": PREFIX, "users": team_count * 2})
+    return lobby_id
+
+
+async def cleanup(lobby_id: int):
+    async with async_engine.begin() as connection:
+        await connection.execute(text("DELETE FROM users WHERE user_hash LIKE :prefix || '%'"), {"prefix": PREFIX})
+        await connection.execute(text("DELETE FROM teams WHERE team_hash LIKE :prefix || '%'"), {"prefix": PREFIX})
+        await connection.execute(text("DELETE FROM lobbies WHERE id = :id"), {"id": lobby_id})
+
+
+async def join(sess: aiohttp.ClientSession, base_url: str, user_hash: str, lobby_id: int) -> int:
+    async with sess.post(f"{base_url}/user/lobby/join", params={"lobby_id": lobby_id},
+                         cookies={"user_hash": user_hash}) as resp:
+        await resp.read()
+        return resp.status
+
+
+async def main(base_url: str, team_count: int):
+    lobby_id = await seed(team_count)
+    try:
+        captains = [f"{PREFIX}user{i}" for i in range(1, team_count * 2, 2)]
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as sess:
+            statuses = await asyncio.gather(*(join(sess, base_url, captain, lobby_id) for captain in captains))
+
+        async with async_engine.connect() as connection:
+            occupancy = (await connection.execute(text("SELECT count(*) FROM teams WHERE lobby_id = :id"),
+                                                  {"id": lobby_id})).scalar_one()
+    finally:
+        await cleanup(lobby_id)
+        await async_engine.dispose()
+
+    accepted = statuses.count(200)
+    print(f"{len(statuses)} joins: {accepted} accepted, final occupancy {occupancy}/{LOBBY_CAPACITY}")
+    if occupancy > LOBBY_CAPACITY or accepted != occupancy:
+        sys.exit("Lobby capacity was violated.")
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 300))
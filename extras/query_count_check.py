@@ -0,0 +1,91 @@
+import asyncio
+import sys
+from urllib.parse import urlencode
+
+from sqlalchemy import event
+
+from app import QUERY_BUDGETS, app
+from dbsql import migrations
+from dbsql.database import async_engine
+from extras.explain_check import USERS, seed
+
+# Calls the endpoints that serialize object graphs against the explain_check dataset and fails if any
+# of them runs a different number of SQL statements than expected. Every list is checked at two page
+# sizes, so a count that grows with the rows returned shows up as a mismatch. The tables are TRUNCATED
+# first, so only point this at a throwaway database: python -m extras.query_count_check --seed
+QUERY_COUNTS = {
+    **QUERY_BUDGETS,
+    "/lobby": 3,
+    "/users/me/invites": 1,
+    "/team/invites": 1,
+}
+CHECKS = [
+    ("/users", {"limit": 10}, None),
+    ("/users", {"limit": 500}, None),
+    ("/teams", {"limit": 10}, None),
+    ("/teams", {"limit": 500}, None),
+    ("/lobbies", {}, None),
+    ("/lobby", {"lobby_id": 5}, None),
+    ("/users/me/invites", {}, f"user{USERS}"),
+    ("/team/invites", {"team_hash": "team1234"}, None),
+]
+
+
+async def call(path: str, params: dict, user_hash: str | None) -> int:
+    headers = [(b"host", b"localhost")]
+    if user_hash is not None:
+        headers.append((b"cookie", f"user_hash={user_hash}".encode()))
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+             "path": path, "raw_path": path.encode(), "root_path": "", "query_string": urlencode(params).encode(),
+             "headers": headers, "client": ("127.0.0.1", 50000), "server": ("localhost", 80)}
+    status = None
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def check() -> list:
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    failures = []
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count)
+    try:
+        for path, params, user_hash in CHECKS:
+            statements.clear()
+            status = await call(path, params, user_hash)
+            expected = QUERY_COUNTS[path]
+            ok = status == 200 and len(statements) == expected
+            print(f"{path:20} {urlencode(params):22} {status} {len(statements)} statements, expected {expected}"
+                  f"{'' if ok else '   FAIL'}")
+            if not ok:
+                failures.append(path)
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", count)
+    return failures
+
+
+async def main():
+    if "--seed" not in sys.argv:
+        sys.exit("This truncates every table in DATABASE_URL. Re-run with --seed against a throwaway database.")
+
+    await migrations.migrate(async_engine)
+    await seed()
+    failures = await check()
+    await async_engine.dispose()
+    if failures:
+        sys.exit(f"Unexpected query counts for: {', '.join(sorted(set(failures)))}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
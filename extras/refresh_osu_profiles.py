@@ -0,0 +1,25 @@
+import asyncio
+
+from dbsql.database import AsyncSessionLocal, async_engine
+from utils import http, osu
+
+# Re-fetches every user's osu! profile and writes back changed ranks, badges and BWS, the same as
+# POST /users/osu/refresh. Against the local stub: OSU_BASE_URL=http://localhost:9000 together with
+# python -m extras.fake_upstreams --port 9000, then python -m extras.refresh_osu_profiles
+
+
+async def main():
+    await http.open_sessions()
+    try:
+        async with AsyncSessionLocal() as db:
+            report = await osu.refresh_profiles(db=db)
+    finally:
+        await http.close_sessions()
+        await async_engine.dispose()
+
+    print(f"{report.users} users: {report.fetched} fetched, {report.missing} missing, {report.failed} failed, "
+          f"{report.updated} updated in {report.seconds:.1f}s ({report.profiles_per_second:.1f} profiles/s)")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
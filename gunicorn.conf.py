@@ -0,0 +1,25 @@
+import os
+import tempfile
+
+# Production server: python main.py without DEV set runs gunicorn with this file.
+bind = f"0.0.0.0:{os.getenv('PORT', 8000)}"
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# On SIGTERM workers stop accepting connections and get this long to finish in-flight requests
+# before they are killed; open /events streams are cut at that point and their clients reconnect.
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+timeout = 60
+keepalive = 5
+
+accesslog = "-"
+forwarded_allow_ips = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+# Workers write their metrics to files here so /metrics can report the whole server. The directory
+# has to start empty, so a fresh one is made unless PROMETHEUS_MULTIPROC_DIR is given.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="gst-metrics-"))
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -6,5 +6,8 @@ from dotenv import load_dotenv
 load_dotenv()
 
 if __name__ == "__main__":
-    port = int(os.getenv("PORT"))
-    uvicorn.run("app:app", host='0.0.0.0', port=port, reload=True)
+    if os.getenv("DEV"):
+        port = int(os.getenv("PORT"))
+        uvicorn.run("app:app", host='0.0.0.0', port=port, reload=True)
+    else:
+        os.execvp("gunicorn", ["gunicorn", "--config", "gunicorn.conf.py", "app:app"])
@@ -0,0 +1,85 @@
+import asyncio
+import datetime
+import logging
+import os
+import random
+from typing import List
+
+from fastapi import HTTPException
+
+from dbsql import crud
+from dbsql.database import AsyncSessionLocal
+from utils.image import upload_binary_file_to_imgur
+
+WORKERS = int(os.getenv("AVATAR_UPLOAD_WORKERS", 2))
+MAX_ATTEMPTS = int(os.getenv("AVATAR_UPLOAD_ATTEMPTS", 5))
+BACKOFF_BASE = 2
+BACKOFF_MAX = 300
+# Also how long a retry or a job queued by another process can wait before it is noticed.
+POLL_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+_wakeup = asyncio.Event()
+_tasks: List[asyncio.Task] = []
+
+
+def notify():
+    _wakeup.set()
+
+
+def backoff(attempts: int) -> datetime.timedelta:
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1))
+    return datetime.timedelta(seconds=random.uniform(delay / 2, delay))
+
+
+def is_retryable(error: HTTPException) -> bool:
+    # upstream_errors reports timeouts and connection failures as 504/502.
+    return error.status_code >= 500 or error.status_code == 429
+
+
+async def run_once() -> bool:
+    async with AsyncSessionLocal() as db:
+        job = await crud.claim_avatar_job(db, max_attempts=MAX_ATTEMPTS)
+        if job is None:
+            return False
+
+        try:
+            data = await upload_binary_file_to_imgur(image=job.image, imgur_client_id=os.getenv("IMGUR_CLIENT_ID"))
+            img_url = data["link"]
+        except HTTPException as e:
+            retry = is_retryable(e) and job.attempts < MAX_ATTEMPTS
+            await crud.retry_avatar_job(db, job_id=job.id, error=f"Imgur returned {e.status_code}.",
+                                        delay=backoff(job.attempts) if retry else None)
+        except (KeyError, TypeError, ValueError):
+            await crud.retry_avatar_job(db, job_id=job.id, error="Imgur returned an unexpected response.",
+                                        delay=backoff(job.attempts) if job.attempts < MAX_ATTEMPTS else None)
+        else:
+            await crud.complete_avatar_job(db, job_id=job.id, team_hash=job.team_hash, img_url=img_url,
+                                           hashes=[job.source_hash, job.pixel_hash])
+        return True
+
+
+async def _work():
+    while True:
+        try:
+            if await run_once():
+                continue
+        except Exception:
+            logger.exception("Avatar upload worker failed")
+
+        try:
+            await asyncio.wait_for(_wakeup.wait(), POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+
+
+def start():
+    _tasks.extend(asyncio.create_task(_work()) for _ in range(WORKERS))
+
+
+async def stop():
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
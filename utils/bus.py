@@ -0,0 +1,115 @@
+import asyncio
+import json
+import logging
+import uuid
+from typing import Callable, Dict, List, Optional
+
+import asyncpg
+
+# Carries cache invalidations, ETag version bumps and SSE events between worker processes over
+# Postgres LISTEN/NOTIFY. Every process applies its own changes locally first and only relays them
+# here, so a single process behaves the same with or without the bus.
+CHANNEL = "gst_sync"
+RECONNECT_DELAY = 5
+# An idle listener is pinged this often so a dropped connection is noticed without traffic.
+HEALTHCHECK_INTERVAL = 30
+# NOTIFY payloads are limited to 8000 bytes.
+MAX_PAYLOAD = 7900
+
+ORIGIN = uuid.uuid4().hex
+logger = logging.getLogger(__name__)
+
+_handlers: Dict[str, Callable] = {}
+_reset_handlers: List[Callable] = []
+_queue: Optional[asyncio.Queue] = None
+_task: Optional[asyncio.Task] = None
+
+
+def register(kind: str, handler: Callable):
+    _handlers[kind] = handler
+
+
+def on_reset(handler: Callable):
+    # Called after the listener reconnects, since anything sent in between was missed.
+    _reset_handlers.append(handler)
+
+
+def send(kind: str, *args) -> bool:
+    if _queue is None:
+        return True
+    payload = json.dumps({"origin": ORIGIN, "kind": kind, "args": args})
+    if len(payload) > MAX_PAYLOAD:
+        return False
+    _queue.put_nowait(("SELECT pg_notify($1, $2)", (CHANNEL, payload), None))
+    return True
+
+
+def fetch(statement: str, *args, callback: Callable) -> bool:
+    # Runs statement on the bus connection, in order with the notifications, and hands the rows to
+    # callback. Retried after a reconnect until it succeeds; False when the bus is not running.
+    if _queue is None:
+        return False
+    _queue.put_nowait((statement, args, callback))
+    return True
+
+
+def _receive(connection, pid, channel, payload):
+    message = json.loads(payload)
+    if message["origin"] == ORIGIN:
+        return
+    handler = _handlers.get(message["kind"])
+    if handler is not None:
+        handler(*message["args"])
+
+
+async def _run(dsn: str):
+    connected_before = False
+    while True:
+        try:
+            connection = await asyncpg.connect(dsn)
+        except (OSError, asyncpg.PostgresError):
+            logger.exception("Could not connect the cache bus, retrying")
+            await asyncio.sleep(RECONNECT_DELAY)
+            continue
+
+        item = None
+        try:
+            await connection.add_listener(CHANNEL, _receive)
+            if connected_before:
+                for handler in _reset_handlers:
+                    handler()
+            connected_before = True
+
+            while True:
+                try:
+                    item = await asyncio.wait_for(_queue.get(), HEALTHCHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    await connection.execute("SELECT 1")
+                    continue
+                statement, args, callback = item
+                rows = await connection.fetch(statement, *args)
+                item = None
+                if callback is not None:
+                    callback(rows)
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+            logger.exception("Cache bus connection lost, reconnecting")
+            if item is not None:
+                _queue.put_nowait(item)
+        finally:
+            connection.terminate()
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+async def start(dsn: str):
+    global _queue, _task
+    _queue = asyncio.Queue()
+    _task = asyncio.create_task(_run(dsn))
+
+
+async def stop():
+    global _queue, _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+    _queue = None
+    _task = None
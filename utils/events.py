@@ -0,0 +1,68 @@
+import asyncio
+import json
+from collections import defaultdict
+from typing import AsyncIterator, Dict, Set
+
+from utils import bus
+
+KEEPALIVE_INTERVAL = 15
+SUBSCRIBER_QUEUE_SIZE = 100
+LOBBIES_CHANNEL = "lobbies"
+
+
+def user_channel(user_hash: str) -> str:
+    return f"user:{user_hash}"
+
+
+def team_channel(team_hash: str) -> str:
+    return f"team:{team_hash}"
+
+
+class EventBroker:
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+
+    def subscribe(self, *channels: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        for channel in channels:
+            self._subscribers[channel].add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue, *channels: str):
+        for channel in channels:
+            subscribers = self._subscribers.get(channel)
+            if subscribers is None:
+                continue
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._subscribers[channel]
+
+    def publish(self, channel: str, event_type: str, **data):
+        self.publish_local(channel, {"type": event_type, **data})
+        bus.send("event", channel, event_type, data)
+
+    def publish_local(self, channel: str, event: dict):
+        for queue in self._subscribers.get(channel, ()):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # A client this far behind reloads from the REST endpoints anyway.
+                pass
+
+
+broker = EventBroker()
+bus.register("event", lambda channel, event_type, data: broker.publish_local(channel, {"type": event_type, **data}))
+
+
+async def stream(*channels: str) -> AsyncIterator[str]:
+    queue = broker.subscribe(*channels)
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        broker.unsubscribe(queue, *channels)
@@ -0,0 +1,50 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Dict
+
+import aiohttp
+from fastapi import HTTPException
+
+from utils import metrics
+
+UPSTREAMS = {
+    "osu": os.getenv("OSU_BASE_URL", "https://osu.ppy.sh"),
+    "discord": os.getenv("DISCORD_BASE_URL", "https://discord.com"),
+    "imgur": os.getenv("IMGUR_BASE_URL", "https://api.imgur.com"),
+}
+
+CONNECTION_LIMIT = int(os.getenv("HTTP_CONNECTION_LIMIT", 50))
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 30
+TIMEOUT = aiohttp.ClientTimeout(total=30, connect=5, sock_connect=5, sock_read=15)
+
+_sessions: Dict[str, aiohttp.ClientSession] = {}
+
+
+async def open_sessions():
+    for name, base_url in UPSTREAMS.items():
+        connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT,
+                                         ttl_dns_cache=DNS_CACHE_TTL,
+                                         keepalive_timeout=KEEPALIVE_TIMEOUT)
+        _sessions[name] = aiohttp.ClientSession(base_url=base_url, connector=connector, timeout=TIMEOUT,
+                                                trace_configs=[metrics.upstream_trace(name)])
+
+
+async def close_sessions():
+    for name in list(_sessions):
+        await _sessions.pop(name).close()
+
+
+def get_session(name: str) -> aiohttp.ClientSession:
+    return _sessions[name]
+
+
+@asynccontextmanager
+async def upstream_errors(name: str):
+    try:
+        yield
+    except asyncio.TimeoutError:
+        raise HTTPException(504, f"Timed out while talking to {name}.")
+    except aiohttp.ClientError:
+        raise HTTPException(502, f"Could not reach {name}.")
@@ -1,23 +1,82 @@
-from typing import List, BinaryIO
+import asyncio
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, NamedTuple, Tuple
 
-import aiohttp
-from PIL import Image
-from fastapi import UploadFile, HTTPException
+from PIL import Image, UnidentifiedImageError
+from fastapi import HTTPException
 
+from utils import http
 
-def check_image_is_in_formats(image_file: BinaryIO, formats: List[str]):
-    image = Image.open(image_file)
-    return image.format.casefold() in formats
+AVATAR_FORMATS = ("png", "jpeg", "gif")
+AVATAR_SIZE = (256, 256)
+# Anything larger is refused before decoding instead of being expanded into memory.
+AVATAR_MAX_PIXELS = 40_000_000
+HASH_CHUNK_SIZE = 1024 * 1024
 
+# Decoding is the memory-hungry part, so it gets a small pool of its own rather than
+# sharing the default threadpool with every sync dependency.
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("IMAGE_WORKERS", 2)), thread_name_prefix="image")
 
-async def upload_binary_file_to_imgur(file: UploadFile, imgur_client_id: str):
+
+class Avatar(NamedTuple):
+    image: bytes
+    # Hash of the decoded thumbnail, so re-encodes of the same picture share one hosted copy.
+    pixel_hash: str
+
+
+def _file_hash(image_file: BinaryIO) -> str:
+    image_file.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: image_file.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    return f"file:{digest.hexdigest()}"
+
+
+def _thumbnail(image_file: BinaryIO, formats: Tuple[str, ...], size: Tuple[int, int]) -> Avatar:
+    try:
+        image_file.seek(0)
+        with Image.open(image_file) as image:
+            if (image.format or "").casefold() not in formats:
+                raise HTTPException(400, "Uploaded file must be one of the following formats: "
+                                         "'.png', '.jpg', '.jpeg', or '.gif'")
+            if image.width * image.height > AVATAR_MAX_PIXELS:
+                raise HTTPException(400, "Uploaded image dimensions are too large.")
+            image.verify()
+
+        # verify() leaves the image unusable, so decode from a fresh handle.
+        image_file.seek(0)
+        with Image.open(image_file) as image:
+            image.draft("RGB", size)
+            image.thumbnail(size)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA")
+            pixels = hashlib.sha256(f"{image.width}x{image.height}".encode())
+            pixels.update(image.convert("RGBA").tobytes())
+            output = io.BytesIO()
+            image.save(output, format="PNG", optimize=True)
+            return Avatar(image=output.getvalue(), pixel_hash=f"pixels:{pixels.hexdigest()}")
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError):
+        raise HTTPException(400, "Uploaded file is not a valid image.")
+
+
+async def hash_upload(image_file: BinaryIO) -> str:
+    return await asyncio.get_running_loop().run_in_executor(_executor, _file_hash, image_file)
+
+
+async def make_avatar(image_file: BinaryIO) -> Avatar:
+    return await asyncio.get_running_loop().run_in_executor(_executor, _thumbnail, image_file, AVATAR_FORMATS,
+                                                            AVATAR_SIZE)
+
+
+async def upload_binary_file_to_imgur(image: bytes, imgur_client_id: str):
     headers = {"Authorization": f"Client-ID {imgur_client_id}"}
-    await file.seek(0)
-    contents = await file.read()
-    data = {"image": contents,
+    data = {"image": image,
             "type": "file"}
-    async with aiohttp.ClientSession(headers=headers) as sess:
-        async with sess.post("https://api.imgur.com/3/upload", data=data) as resp:
+    async with http.upstream_errors("imgur"):
+        async with http.get_session("imgur").post("/3/upload", data=data, headers=headers) as resp:
             response = await resp.json()
     if response["status"] != 200:
         raise HTTPException(response["status"])
@@ -0,0 +1,135 @@
+import codecs
+import collections
+import csv
+import json
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+CSV_CONTENT_TYPES = ("text/csv", "application/csv")
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+
+def required_str(value) -> str:
+    if value is None or value == "":
+        raise ValueError("missing value")
+    return str(value)
+
+
+def optional_int(value) -> Optional[int]:
+    if value is None or value == "":
+        return None
+    return int(float(value))
+
+
+class _LineQueue:
+    # csv.reader pulls lines from this; iter_csv_rows refills it between chunks, so the reader and its
+    # line_num carry over from one chunk to the next.
+    def __init__(self):
+        self.lines = collections.deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+
+async def iter_text(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    # utf-8-sig drops the byte order mark spreadsheet exports put in front of the header.
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    try:
+        async for chunk in chunks:
+            yield decoder.decode(chunk)
+        yield decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        raise HTTPException(400, "Uploads must be UTF-8 encoded.")
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, str]]:
+    buffer = ""
+    line_number = 0
+    async for text in iter_text(chunks):
+        buffer += text
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            line_number += 1
+            yield line_number, line.rstrip("\r")
+
+    if buffer:
+        yield line_number + 1, buffer.rstrip("\r")
+
+
+async def iter_csv_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, List[str]]]:
+    # Only whole records are handed to the reader: a newline ends a record when the quotes before it are
+    # balanced, so quoted fields may span lines and chunks. Yields the reader's line_num with each row.
+    queue = _LineQueue()
+    reader = csv.reader(queue)
+    record = []
+    record_size = 0
+    in_quotes = False
+    buffer = ""
+    async for text in iter_text(chunks):
+        buffer += text
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            record.append(line + "\n")
+            record_size += len(line) + 1
+            in_quotes ^= line.count('"') % 2 == 1
+            if not in_quotes:
+                queue.lines.extend(record)
+                record.clear()
+                record_size = 0
+            elif record_size > csv.field_size_limit():
+                raise csv.Error(f"line {reader.line_num + 1}: unterminated quoted field")
+
+        for values in reader:
+            yield reader.line_num, values
+
+    if buffer:
+        record.append(buffer)
+        in_quotes ^= buffer.count('"') % 2 == 1
+    if in_quotes:
+        raise csv.Error(f"line {reader.line_num + 1}: unterminated quoted field")
+    queue.lines.extend(record)
+    for values in reader:
+        yield reader.line_num, values
+
+
+async def iter_records(chunks: AsyncIterator[bytes], content_type: str,
+                       columns: Dict[str, Callable]) -> AsyncIterator[tuple]:
+    # Each record is the source line number followed by the converted columns.
+    content_type = content_type.split(";")[0].strip().casefold()
+    if content_type not in CSV_CONTENT_TYPES + NDJSON_CONTENT_TYPES:
+        raise HTTPException(415, "Uploads must be CSV (text/csv) or NDJSON (application/x-ndjson).")
+    if content_type in CSV_CONTENT_TYPES:
+        rows = iter_csv_rows(chunks)
+    else:
+        rows = iter_lines(chunks)
+
+    header = None
+    line_number = 0
+    try:
+        async for line_number, row in rows:
+            if isinstance(row, str):
+                if not row.strip():
+                    continue
+                row = json.loads(row)
+            else:
+                if len(row) <= 1 and not "".join(row).strip():
+                    continue
+                if header is None:
+                    header = [value.strip() for value in row]
+                    missing = set(columns) - set(header)
+                    if missing:
+                        raise ValueError(f"missing columns {', '.join(sorted(missing))}")
+                    continue
+                row = dict(zip(header, row))
+
+            yield (line_number, *(convert(row.get(name)) for name, convert in columns.items()))
+    except csv.Error as e:
+        raise HTTPException(400, f"Invalid CSV: {e}")
+    except (ValueError, TypeError, AttributeError) as e:
+        raise HTTPException(400, f"Line {line_number}: {e}")
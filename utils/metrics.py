@@ -0,0 +1,134 @@
+import os
+import time
+from contextvars import ContextVar
+from types import SimpleNamespace
+from typing import Optional, Tuple
+
+import aiohttp
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import REGISTRY, multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR and /metrics merges them.
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time spent serving a request.",
+                            ["method", "route", "status"], buckets=LATENCY_BUCKETS)
+REQUEST_STATEMENTS = Histogram("http_request_db_statements", "SQL statements executed per request.",
+                               ["method", "route"], buckets=STATEMENT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram("http_request_db_seconds", "Time spent in SQL statements per request.",
+                               ["method", "route"], buckets=LATENCY_BUCKETS)
+DB_STATEMENTS = Counter("db_statements", "SQL statements executed, in or outside a request.")
+POOL_CHECKOUT_SECONDS = Histogram("db_pool_checkout_seconds", "Time waited for a pooled connection.",
+                                  buckets=LATENCY_BUCKETS)
+POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Connections currently checked out of the pool.",
+                         multiprocess_mode="livesum")
+POOL_CAPACITY = Gauge("db_pool_capacity", "Pool size plus allowed overflow.", multiprocess_mode="livesum")
+UPSTREAM_SECONDS = Histogram("upstream_request_duration_seconds", "Time spent on calls to third-party APIs.",
+                             ["upstream", "method", "status"], buckets=LATENCY_BUCKETS)
+
+# Per-request SQL totals; SQLAlchemy copies the context into the greenlets its events run in.
+request_stats: ContextVar[Optional[SimpleNamespace]] = ContextVar("request_stats", default=None)
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine: Engine):
+    if isinstance(engine.pool, QueuePool):
+        POOL_CAPACITY.inc(engine.pool.size() + max(engine.pool._max_overflow, 0))
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        DB_STATEMENTS.inc()
+        stats = request_stats.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_seconds += elapsed
+            if stats.queries is not None:
+                stats.queries.append((statement, parameters, elapsed))
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        POOL_CHECKED_OUT.inc()
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        POOL_CHECKED_OUT.dec()
+
+
+def upstream_trace(upstream: str) -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params):
+        context.started = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        UPSTREAM_SECONDS.labels(upstream, params.method, str(params.response.status)).observe(
+            time.perf_counter() - context.started)
+
+    async def on_request_exception(session, context, params):
+        UPSTREAM_SECONDS.labels(upstream, params.method, "error").observe(time.perf_counter() - context.started)
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        # queries stays None unless the development profiler asks for every statement.
+        stats = SimpleNamespace(statements=0, db_seconds=0.0, queries=None)
+        token = request_stats.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            request_stats.reset(token)
+            # The route template rather than the raw path keeps label cardinality bounded.
+            route = scope.get("route")
+            labels = (scope["method"], route.path if route is not None else "unmatched")
+            REQUEST_SECONDS.labels(*labels, str(status)).observe(time.perf_counter() - started)
+            REQUEST_STATEMENTS.labels(*labels).observe(stats.statements)
+            REQUEST_DB_SECONDS.labels(*labels).observe(stats.db_seconds)
+
+
+def render() -> Tuple[bytes, str]:
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
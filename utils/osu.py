@@ -0,0 +1,119 @@
+import asyncio
+import os
+import time
+from typing import Iterable, Optional, Sequence
+
+import numpy as np
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from dbsql import crud, schemas
+from utils import http
+from utils.ratelimit import TokenBucket
+
+BADGE_WORD_FILTER = [
+    "taiko",
+    "catch",
+    "mania",
+    "mapping",
+    "nominator",
+    "nomination",
+    "beatmap",
+    "contribution",
+    "mappers'",
+    "mapper's",
+    "mapper",
+    "spotlight",
+    "playlist",
+    "fanart",
+]
+
+REFRESH_CONCURRENCY = int(os.getenv("OSU_REFRESH_CONCURRENCY", 8))
+# Requests per second against the osu! API, with short bursts of up to REFRESH_BURST.
+REFRESH_RATE = float(os.getenv("OSU_REFRESH_RATE", 5))
+REFRESH_BURST = 10
+
+
+def count_badges(badges: Iterable[dict]) -> int:
+    # Badges whose description contains any filtered word do not count.
+    return sum(1 for badge in badges
+               if not any(filter_word in badge["description"].casefold() for filter_word in BADGE_WORD_FILTER))
+
+
+def bws_ranks(global_ranks: Sequence[Optional[int]], badge_counts: Sequence[int]) -> np.ndarray:
+    ranks = np.array(global_ranks, dtype=np.float64)
+    ranks = np.where(ranks >= 0, ranks, 0)
+    badges = np.asarray(badge_counts, dtype=np.float64)
+    return np.rint(ranks ** (0.9937 ** (badges ** 2))).astype(np.int64)
+
+
+def bws_rank(global_rank: Optional[int], badge_count: int) -> int:
+    return int(bws_ranks([global_rank], [badge_count])[0])
+
+
+async def get_client_token() -> str:
+    token_body = {
+        "client_id": os.getenv("OSU_CLIENT_ID"),
+        "client_secret": os.getenv("OSU_CLIENT_SECRET"),
+        "grant_type": "client_credentials",
+        "scope": "public",
+    }
+    async with http.upstream_errors("osu"):
+        async with http.get_session("osu").post("/oauth/token", data=token_body) as resp:
+            contents = await resp.json()
+
+    access_token = contents.get("access_token")
+    if not access_token:
+        raise HTTPException(500, "Could not get an osu! API token.")
+    return access_token
+
+
+async def get_profile(access_token: str, osu_id: int, bucket: TokenBucket) -> Optional[dict]:
+    await bucket.acquire()
+    headers = {"Authorization": f"Bearer {access_token}"}
+    async with http.upstream_errors("osu"):
+        async with http.get_session("osu").get(f"/api/v2/users/{osu_id}/osu", params={"key": "id"},
+                                               headers=headers) as resp:
+            # Restricted and deleted accounts keep their last known values.
+            if resp.status == 404:
+                return None
+            resp.raise_for_status()
+            return await resp.json()
+
+
+async def refresh_profiles(db: AsyncSession) -> schemas.ProfileRefresh:
+    started = time.perf_counter()
+    users = await crud.get_osu_profiles(db)
+    # Nothing else needs the database until the write-back, so give the connection back meanwhile.
+    await db.close()
+
+    access_token = await get_client_token()
+    bucket = TokenBucket(rate=REFRESH_RATE, capacity=REFRESH_BURST)
+    semaphore = asyncio.Semaphore(REFRESH_CONCURRENCY)
+
+    async def fetch(osu_id: int):
+        async with semaphore:
+            try:
+                return await get_profile(access_token, osu_id, bucket)
+            except HTTPException as e:
+                return e
+
+    profiles = await asyncio.gather(*(fetch(user.osu_id) for user in users))
+    fetched = [(user, profile) for user, profile in zip(users, profiles) if isinstance(profile, dict)]
+    failed = sum(1 for profile in profiles if isinstance(profile, HTTPException))
+
+    global_ranks = [(profile.get("statistics") or {}).get("global_rank") for _, profile in fetched]
+    badge_counts = [count_badges(profile.get("badges", [])) for _, profile in fetched]
+    changes = []
+    for (user, profile), global_rank, badge_count, bws in zip(fetched, global_ranks, badge_counts,
+                                                              bws_ranks(global_ranks, badge_counts).tolist()):
+        values = {"osu_global_rank": global_rank, "badges": badge_count, "bws_rank": bws,
+                  "osu_avatar_url": profile.get("avatar_url", user.osu_avatar_url)}
+        if any(getattr(user, name) != value for name, value in values.items()):
+            changes.append({"user_hash": user.user_hash, **values})
+
+    await crud.update_osu_profiles(db, changes)
+    seconds = time.perf_counter() - started
+    return schemas.ProfileRefresh(users=len(users), fetched=len(fetched), missing=len(users) - len(fetched) - failed,
+                                  failed=failed, updated=len(changes), seconds=round(seconds, 3),
+                                  profiles_per_second=round(len(users) / seconds, 2) if seconds else 0)
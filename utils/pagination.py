@@ -0,0 +1,22 @@
+import base64
+import json
+from typing import Any, List, Optional
+
+from fastapi import HTTPException
+
+
+def encode_cursor(*values: Any) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str], size: int) -> Optional[List[Any]]:
+    if cursor is None:
+        return None
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise HTTPException(400, "Invalid cursor.")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(400, "Invalid cursor.")
+    return values
@@ -0,0 +1,109 @@
+import json
+import logging
+import re
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from utils import metrics
+
+# Development aid: records every statement a request runs on top of the per-request stats that
+# utils.metrics keeps, and reports them in response headers and through /debug/queries.
+HISTORY_SIZE = 50
+TOP_STATEMENTS = 5
+# The same statement run this many times with different parameters in one request is reported
+# as an N+1: a query per row of an earlier result instead of one query for all of them.
+N_PLUS_ONE_MIN = 3
+
+# Placeholders of every DB-API paramstyle; the asyncpg dialect renders plain %s.
+_PLACEHOLDER = r"(?:\$\d+|%\(\w+\)s|%s|\?)"
+_PARAMETER_LISTS = re.compile(rf"{_PLACEHOLDER}(?:\s*,\s*{_PLACEHOLDER})*")
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_WHITESPACE = re.compile(r"\s+")
+
+logger = logging.getLogger(__name__)
+
+profiles: Deque[dict] = deque(maxlen=HISTORY_SIZE)
+
+
+def normalize(statement: str) -> str:
+    # Expanded IN lists and inlined literals collapse to one placeholder, so only the shape is compared.
+    statement = _PARAMETER_LISTS.sub("?", _WHITESPACE.sub(" ", statement).strip())
+    return _LITERALS.sub("?", statement)
+
+
+def summarize(queries: List[tuple]) -> dict:
+    groups: Dict[str, dict] = {}
+    for statement, parameters, elapsed in queries:
+        group = groups.setdefault(normalize(statement), {"count": 0, "ms": 0.0, "parameters": set()})
+        group["count"] += 1
+        group["ms"] += elapsed * 1000
+        group["parameters"].add(repr(parameters))
+
+    statements = [{"statement": statement, "count": group["count"], "ms": round(group["ms"], 3),
+                   "distinct_parameters": len(group["parameters"])}
+                  for statement, group in groups.items()]
+    statements.sort(key=lambda group: (group["count"], group["ms"]), reverse=True)
+    return {"statements": len(queries),
+            "db_ms": round(sum(elapsed for _, _, elapsed in queries) * 1000, 3),
+            "n_plus_one": [group for group in statements
+                           if group["count"] >= N_PLUS_ONE_MIN and group["distinct_parameters"] > 1],
+            "top": statements[:TOP_STATEMENTS]}
+
+
+class QueryProfilerMiddleware:
+    # Must sit inside MetricsMiddleware, which owns the per-request stats. budgets maps a route
+    # template to the most statements it may run; default_budget applies to every other route.
+    # With strict set an over-budget response is replaced by a 500, so scripted runs fail loudly.
+    def __init__(self, app, budgets: Optional[Dict[str, int]] = None, default_budget: Optional[int] = None,
+                 strict: bool = False, exclude: tuple = ()):
+        self.app = app
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.strict = strict
+        self.exclude = exclude
+
+    async def __call__(self, scope, receive, send):
+        stats = metrics.request_stats.get()
+        if scope["type"] != "http" or stats is None or scope["path"] in self.exclude:
+            await self.app(scope, receive, send)
+            return
+
+        stats.queries = []
+        over_budget = None
+
+        async def send_with_profile(message):
+            nonlocal over_budget
+            if message["type"] == "http.response.start":
+                route = scope.get("route")
+                route = route.path if route is not None else scope["path"]
+                profile = {"method": scope["method"], "route": route, "path": scope["path"],
+                           "status": message["status"], **summarize(stats.queries)}
+                profiles.appendleft(profile)
+
+                budget = self.budgets.get(route, self.default_budget)
+                if budget is not None and profile["statements"] > budget:
+                    over_budget = (f"{scope['method']} {route} ran {profile['statements']} SQL statements, "
+                                   f"over its budget of {budget}.")
+                    logger.warning(over_budget)
+                for group in profile["n_plus_one"]:
+                    logger.warning("Possible N+1 in %s %s: %d x %s", scope["method"], route, group["count"],
+                                   group["statement"])
+
+                headers = [(b"server-timing", f'db;dur={profile["db_ms"]};desc="{profile["statements"]} '
+                                              f'queries"'.encode()),
+                           (b"x-db-queries", str(profile["statements"]).encode()),
+                           (b"x-db-n-plus-one", str(len(profile["n_plus_one"])).encode())]
+                if over_budget is not None and self.strict:
+                    body = json.dumps({"detail": over_budget}).encode()
+                    await send({"type": "http.response.start", "status": 500,
+                                "headers": [(b"content-type", b"application/json"),
+                                            (b"content-length", str(len(body)).encode()), *headers]})
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                message = {**message, "headers": [*message.get("headers", []), *headers]}
+            elif over_budget is not None and self.strict:
+                # The original body was replaced above.
+                return
+            await send(message)
+
+        await self.app(scope, receive, send_with_profile)
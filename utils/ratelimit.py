@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+from starlette.requests import cookie_parser
+
+from utils import bus
+
+# With RATE_LIMIT_SHARED each worker relays the tokens its clients spent to the others every
+# SHARE_INTERVAL, so a client spread over several workers still gets one budget, give or take
+# what it spends within an interval.
+SHARED = bool(os.getenv("RATE_LIMIT_SHARED"))
+SHARE_INTERVAL = 1
+# Clients per notification; a digest and a count take about 30 bytes of the payload.
+SHARE_BATCH = 200
+# Idle clients beyond this many per route are forgotten; a forgotten client starts with a full bucket.
+MAX_CLIENTS = 10000
+RETRY_AFTER_OVERLOADED = 1
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        self._refill()
+        if self._tokens < tokens:
+            return False
+        self._tokens -= tokens
+        return True
+
+    def retry_after(self, tokens: float = 1) -> float:
+        self._refill()
+        return max(0.0, (tokens - self._tokens) / self.rate)
+
+    def spend(self, tokens: float):
+        # Tokens used elsewhere; the debt is capped so a client is never locked out for long.
+        self._refill()
+        self._tokens = max(-self.capacity, self._tokens - tokens)
+
+    async def acquire(self, tokens: float = 1):
+        # Waiters queue on the lock, so tokens are handed out in arrival order.
+        async with self._lock:
+            self._refill()
+            if self._tokens < tokens:
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= tokens
+
+
+class RouteLimit(NamedTuple):
+    # Per client: a sustained rate in requests per second and a burst on top of it.
+    rate: float
+    burst: int
+    # Requests to the route in flight in this process; more are turned away with a 503.
+    concurrency: int
+
+
+class ClientBuckets:
+    def __init__(self, limit: RouteLimit):
+        self.limit = limit
+        self._buckets: OrderedDict = OrderedDict()
+
+    def get(self, client: str) -> TokenBucket:
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(rate=self.limit.rate, capacity=self.limit.burst)
+            if len(self._buckets) > MAX_CLIENTS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+        return bucket
+
+
+_routes: Dict[str, ClientBuckets] = {}
+_spent: Dict[str, Dict[str, float]] = {}
+_task: Optional[asyncio.Task] = None
+
+
+def client_key(scope, is_user: Callable[[str], bool]) -> str:
+    # The signed-in user where the cookie belongs to one, the client address otherwise, so a made-up
+    # cookie never buys a fresh bucket. Only a digest is kept, since the cookie is the user's credential.
+    client = None
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            client = cookie_parser(value.decode("latin-1")).get("user_hash")
+            break
+    if not client or not is_user(client):
+        client = "address:" + (scope["client"][0] if scope.get("client") else "unknown")
+    return hashlib.blake2b(client.encode(), digest_size=8).hexdigest()
+
+
+def route_key(method: str, path: str) -> str:
+    return f"{method} {path}"
+
+
+def _apply_spent(route: str, spent: Dict[str, float]):
+    buckets = _routes.get(route)
+    if buckets is not None:
+        for client, tokens in spent.items():
+            buckets.get(client).spend(tokens)
+
+
+def _flush():
+    for route in list(_spent):
+        spent = list(_spent.pop(route).items())
+        for start in range(0, len(spent), SHARE_BATCH):
+            bus.send("ratelimit", route, dict(spent[start:start + SHARE_BATCH]))
+
+
+async def _share():
+    while True:
+        await asyncio.sleep(SHARE_INTERVAL)
+        _flush()
+
+
+def start():
+    global _task
+    if SHARED:
+        _task = asyncio.create_task(_share())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+    _task = None
+
+
+class AdmissionMiddleware:
+    # Applies a RouteLimit per (method, path). is_user tells whether a user_hash cookie belongs to a
+    # real user; it is called on every limited request, so it must not touch the database.
+    # Rejections are answered before routing, so they never touch the database either.
+    def __init__(self, app, limits: Dict[Tuple[str, str], RouteLimit], is_user: Callable[[str], bool]):
+        self.app = app
+        self.limits = {route_key(method, path): limit for (method, path), limit in limits.items()}
+        self.is_user = is_user
+        self.in_flight = dict.fromkeys(self.limits, 0)
+        for route, limit in self.limits.items():
+            _routes[route] = ClientBuckets(limit)
+
+    async def __call__(self, scope, receive, send):
+        route = route_key(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if route not in self.limits:
+            await self.app(scope, receive, send)
+            return
+
+        if self.in_flight[route] >= self.limits[route].concurrency:
+            await self._reject(send, 503, "The server is busy, try again shortly.", RETRY_AFTER_OVERLOADED)
+            return
+        client = client_key(scope, self.is_user)
+        bucket = _routes[route].get(client)
+        if not bucket.try_acquire():
+            await self._reject(send, 429, "Too many requests, slow down.", bucket.retry_after())
+            return
+        if SHARED:
+            spent = _spent.setdefault(route, {})
+            spent[client] = spent.get(client, 0) + 1
+
+        self.in_flight[route] += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight[route] -= 1
+
+    @staticmethod
+    async def _reject(send, status: int, detail: str, retry_after: float):
+        body = json.dumps({"detail": detail}).encode()
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(body)).encode()),
+                                (b"retry-after", str(max(1, math.ceil(retry_after))).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+
+bus.register("ratelimit", _apply_spent)
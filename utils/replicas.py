@@ -0,0 +1,45 @@
+import os
+from contextvars import ContextVar
+from types import SimpleNamespace
+from typing import Optional
+
+from sqlalchemy import event
+
+# How far the replicas may trail the primary. For that long after a request commits, its client
+# carries STICKY_COOKIE and reads from the primary, so it always sees its own writes.
+REPLICA_MAX_LAG = int(os.getenv("REPLICA_MAX_LAG", 5))
+STICKY_COOKIE = "read_primary"
+
+_request: ContextVar[Optional[SimpleNamespace]] = ContextVar("replica_request", default=None)
+
+
+def track_writes(session_class):
+    @event.listens_for(session_class, "after_commit")
+    def after_commit(session):
+        state = _request.get()
+        if state is not None:
+            state.wrote = True
+
+
+class ReadYourWritesMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        state = SimpleNamespace(wrote=False)
+        token = _request.set(state)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and state.wrote:
+                cookie = f"{STICKY_COOKIE}=1; Max-Age={REPLICA_MAX_LAG}; Path=/; SameSite=lax"
+                message = {**message, "headers": [*message.get("headers", []), (b"set-cookie", cookie.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            _request.reset(token)
@@ -0,0 +1,26 @@
+import numpy as np
+
+
+# Z-scores every score against the other scores of its group (map) in one pass.
+# Missing scores are NaN and stay NaN; a group without spread gets a z-score of 0.
+def compute_zscores(groups: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    groups = np.asarray(groups, dtype=np.intp)
+    scores = np.asarray(scores, dtype=np.float64)
+    if scores.size == 0:
+        return scores.copy()
+
+    present = ~np.isnan(scores)
+    group_count = groups.max() + 1
+    counts = np.bincount(groups, weights=present, minlength=group_count)
+    sums = np.bincount(groups, weights=np.where(present, scores, 0.0), minlength=group_count)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+        deviations = np.where(present, scores - means[groups], 0.0)
+        variances = np.bincount(groups, weights=deviations ** 2, minlength=group_count) / (counts - 1)
+        stds = np.sqrt(variances)[groups]
+        zscores = deviations / stds
+
+    zscores[present & ~(stds > 0)] = 0.0
+    zscores[~present] = np.nan
+    return zscores